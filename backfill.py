@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+parser = argparse.ArgumentParser(
+    description="Link the existing tickets of a pagure project to the "
+    "issues/user stories of its taiga project"
+)
+parser.add_argument(
+    "--config",
+    "-c",
+    dest="config",
+    help="Configuration file to use for pagure.",
+)
+parser.add_argument(
+    "project", help="Project to backfill, as <repo> or <namespace>/<repo>."
+)
+parser.add_argument(
+    "--user",
+    dest="user",
+    required=True,
+    help="User the tickets created in pagure are opened as.",
+)
+parser.add_argument(
+    "--workers",
+    dest="workers",
+    type=int,
+    default=4,
+    help="Maximum number of tickets created in taiga concurrently "
+    "(defaults to 4).",
+)
+parser.add_argument(
+    "--page-size",
+    dest="page_size",
+    type=int,
+    default=100,
+    help="Number of tickets retrieved and processed at once "
+    "(defaults to 100).",
+)
+parser.add_argument(
+    "--checkpoint",
+    dest="checkpoint",
+    help="File storing the progress of the backfill so it can be resumed "
+    "(defaults to .pagure-taiga-backfill-<project>.json).",
+)
+
+args = parser.parse_args()
+
+if args.config:
+    config = args.config
+    if not config.startswith("/"):
+        here = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+        config = os.path.join(here, config)
+    os.environ["PAGURE_CONFIG"] = config
+
+import pagure.config  # noqa: E402
+import pagure.lib.model  # noqa: E402
+import pagure.lib.model_base  # noqa: E402
+import pagure.lib.query  # noqa: E402
+
+from pagure_taiga import client, model, query  # noqa: E402
+
+
+class Progress(object):
+    """ Keeps track of and reports on the progress of the backfill. """
+
+    def __init__(self):
+        self.start = time.time()
+        self.counts = {"matched": 0, "created_taiga": 0, "created_pagure": 0}
+
+    def report(self, step):
+        duration = time.time() - self.start
+        total = sum(self.counts.values())
+        print(
+            "%s - matched: %s, created in taiga: %s, created in pagure: %s "
+            "(%.1f tickets/s)"
+            % (
+                step,
+                self.counts["matched"],
+                self.counts["created_taiga"],
+                self.counts["created_pagure"],
+                total / duration if duration else 0,
+            )
+        )
+
+
+def load_checkpoint(path):
+    if os.path.exists(path):
+        with open(path) as stream:
+            return json.load(stream)
+    return {"last_pagure_id": 0}
+
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as stream:
+        json.dump(checkpoint, stream)
+    os.rename(tmp_path, path)
+
+
+def iter_pagure_issues(session, project, last_id, page_size):
+    """ Yields pages of the tickets of the specified pagure project whose
+    identifier is above the given one.
+    """
+    while True:
+        issues = (
+            session.query(pagure.lib.model.Issue)
+            .filter(
+                pagure.lib.model.Issue.project_id == project.id,
+                pagure.lib.model.Issue.id > last_id,
+            )
+            .order_by(pagure.lib.model.Issue.id)
+            .limit(page_size)
+            .all()
+        )
+        if not issues:
+            break
+        yield issues
+        last_id = issues[-1].id
+
+
+def main():
+    if "/" in args.project:
+        namespace, reponame = args.project.split("/", 1)
+    else:
+        namespace, reponame = None, args.project
+    checkpoint_path = args.checkpoint or (
+        ".pagure-taiga-backfill-%s.json" % args.project.replace("/", "-")
+    )
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    session = pagure.lib.model_base.create_session(
+        pagure.config.config["DB_URL"]
+    )
+    project = pagure.lib.query.get_authorized_project(
+        session, reponame, namespace=namespace
+    )
+    if not project or not project.taiga:
+        print("No project %s linked to taiga found" % args.project)
+        return 1
+
+    api = client.get_api(project.taiga)
+    taiga_project = client.get_project(api, project.taiga)
+    taiga_type = query.get_taiga_type(project.taiga)
+    progress = Progress()
+
+    mapped = (
+        session.query(
+            model.PagureTaigaMapping.pagure_ticket_id,
+            model.PagureTaigaMapping.taiga_id,
+        )
+        .filter(
+            model.PagureTaigaMapping.taiga_project == taiga_project.id,
+            model.PagureTaigaMapping.taiga_type == taiga_type,
+        )
+        .all()
+    )
+    mapped_pagure = set(row.pagure_ticket_id for row in mapped)
+    mapped_taiga = set(row.taiga_id for row in mapped)
+
+    # Index the unmapped tickets of taiga per title
+    unmapped_taiga = {}
+    for ticket in client.iter_tickets(
+        api, taiga_project.id, taiga_type, page_size=args.page_size
+    ):
+        if ticket["ref"] not in mapped_taiga:
+            unmapped_taiga.setdefault(ticket["subject"], []).append(ticket)
+    progress.report("Taiga tickets retrieved")
+
+    def create_in_taiga(issue):
+        # Wait when taiga, or the rate limiter, asks us to slow down, as the
+        # tasks do, rather than aborting the backfill
+        retries = 0
+        while True:
+            try:
+                return query.create_taiga_ticket(
+                    taiga_project,
+                    taiga_type,
+                    title=issue.title,
+                    content=issue.content,
+                    priority=issue.priority,
+                    status=issue.status,
+                )
+            except client.TaigaUnavailable as err:
+                settings = pagure.config.config
+                if retries >= settings.get("PAGURE_TAIGA_MAX_RETRIES", 8):
+                    raise
+                delay = min(
+                    settings.get("PAGURE_TAIGA_RETRY_DELAY", 2) * 2 ** retries,
+                    600,
+                )
+                retries += 1
+                time.sleep(max(delay, err.retry_after or 0))
+
+    # Match or create in taiga the tickets of pagure
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for issues in iter_pagure_issues(
+            session, project, checkpoint["last_pagure_id"], args.page_size
+        ):
+            rows = []
+            to_create = []
+            for issue in issues:
+                if issue.id in mapped_pagure:
+                    continue
+                candidates = unmapped_taiga.get(issue.title)
+                if candidates:
+                    ticket = candidates.pop(0)
+                    rows.append((issue.id, ticket["ref"], ticket["id"]))
+                    progress.counts["matched"] += 1
+                else:
+                    to_create.append(issue)
+            for issue, ticket in zip(
+                to_create, executor.map(create_in_taiga, to_create)
+            ):
+                rows.append((issue.id, ticket.ref, ticket.id))
+                progress.counts["created_taiga"] += 1
+
+            session.bulk_insert_mappings(
+                model.PagureTaigaMapping,
+                [
+                    dict(
+                        taiga_project=taiga_project.id,
+                        taiga_id=taiga_id,
+                        pagure_ticket_id=pagure_id,
+                        taiga_type=taiga_type,
+                        taiga_object_id=object_id,
+                    )
+                    for pagure_id, taiga_id, object_id in rows
+                ],
+            )
+            session.commit()
+            checkpoint["last_pagure_id"] = issues[-1].id
+            save_checkpoint(checkpoint_path, checkpoint)
+            progress.report("Pagure tickets up to #%s" % issues[-1].id)
+
+    # Create in pagure the tickets of taiga left unmatched
+    for tickets in unmapped_taiga.values():
+        for ticket in tickets:
+            issue_id = pagure.lib.query.get_next_id(session, project.id)
+            pagure.lib.query.new_issue(
+                session,
+                repo=project,
+                issue_id=issue_id,
+                title=ticket["subject"],
+                content=ticket.get("description") or ticket["subject"],
+                user=args.user,
+                tags=[ticket["status_extra_info"]["name"]]
+                + [tag[0] for tag in ticket["tags"]],
+                notify=False,
+            )
+            session.add(
+                model.PagureTaigaMapping(
+                    taiga_project=taiga_project.id,
+                    taiga_id=ticket["ref"],
+                    pagure_ticket_id=issue_id,
+                    taiga_type=taiga_type,
+                    taiga_object_id=ticket["id"],
+                )
+            )
+            session.commit()
+            progress.counts["created_pagure"] += 1
+            if progress.counts["created_pagure"] % args.page_size == 0:
+                progress.report("Taiga tickets added to pagure")
+
+    progress.report("Done")
+    session.remove()
+    # No checkpoint is saved if there was no pagure ticket to process
+    if os.path.exists(checkpoint_path):
+        os.unlink(checkpoint_path)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+parser = argparse.ArgumentParser(
+    description="Measure the time taken to look up many taiga tickets, one "
+    "after the other and pipelined as done by the reconciliation, against a "
+    "stub taiga server answering after a fixed latency. Nothing is sent to a "
+    "real taiga instance nor stored in pagure's database or redis."
+)
+parser.add_argument(
+    "--config",
+    "-c",
+    dest="config",
+    help="Configuration file to use for pagure.",
+)
+parser.add_argument(
+    "--tickets",
+    "-n",
+    dest="tickets",
+    type=int,
+    default=200,
+    help="Number of tickets looked up (defaults to 200).",
+)
+parser.add_argument(
+    "--latency",
+    dest="latency",
+    type=float,
+    default=0.05,
+    help="Time, in seconds, the stub taiga takes to answer each request "
+    "(defaults to 0.05).",
+)
+parser.add_argument(
+    "--threads",
+    dest="threads",
+    type=int,
+    default=8,
+    help="Number of lookups run at once when pipelined, as set by "
+    "PAGURE_TAIGA_LOOKUP_THREADS (defaults to 8).",
+)
+
+args = parser.parse_args()
+
+if args.config:
+    config = args.config
+    if not config.startswith("/"):
+        here = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+        config = os.path.join(here, config)
+    os.environ["PAGURE_CONFIG"] = config
+
+from pagure.config import config as pagure_config  # noqa: E402
+
+from pagure_taiga import client  # noqa: E402
+from pagure_taiga import metrics  # noqa: E402
+
+TICKET_RE = re.compile(r"^/api/v1/+(issues|userstories)/(\d+)/?$")
+
+
+class StubTaigaHandler(BaseHTTPRequestHandler):
+    """ Answers the lookups of tickets by identifier, after the configured
+    latency.
+    """
+
+    def do_GET(self):
+        time.sleep(args.latency)
+        match = TICKET_RE.match(self.path.split("?", 1)[0])
+        if not match:
+            self.send_error(404)
+            return
+        object_id = int(match.group(2))
+        body = json.dumps(
+            {
+                "id": object_id,
+                "ref": object_id,
+                "project": 1,
+                "subject": "Ticket %s" % object_id,
+                "status": 1,
+                "status_extra_info": {"name": "New"},
+                "tags": [],
+                "version": 1,
+                "total_comments": 0,
+                "modified_date": "2019-01-01T00:00:00Z",
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubTaigaServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def lookup(api, object_id):
+    """ Look up the specified user story as the reconciliation does. """
+    return client.get_ticket_data(api, "userstory", object_id=object_id)
+
+
+def main():
+    # The stub is not rate-limited and the metrics of its requests are not
+    # sent to redis
+    pagure_config["PAGURE_TAIGA_RATE_LIMIT"] = 0
+    pagure_config["PAGURE_TAIGA_METRICS_FLUSH_INTERVAL"] = float("inf")
+    pagure_config["PAGURE_TAIGA_LOOKUP_THREADS"] = args.threads
+
+    server = StubTaigaServer(("127.0.0.1", 0), StubTaigaHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    TaigaConfig = collections.namedtuple(
+        "TaigaConfig", ["taiga_url", "taiga_token"]
+    )
+    api = client.get_api(
+        TaigaConfig("http://127.0.0.1:%s" % server.server_port, "token")
+    )
+    object_ids = list(range(1, args.tickets + 1))
+
+    # Open the connections before measuring
+    lookup(api, 1)
+    client.map_concurrently(
+        lambda object_id: lookup(api, object_id), [1] * args.threads
+    )
+
+    start = time.time()
+    for object_id in object_ids:
+        lookup(api, object_id)
+    serial = time.time() - start
+
+    start = time.time()
+    client.map_concurrently(
+        lambda object_id: lookup(api, object_id), object_ids
+    )
+    pipelined = time.time() - start
+
+    server.shutdown()
+    metrics.discard()
+
+    print(
+        "Tickets: %s, stub latency: %.0fms, threads: %s"
+        % (args.tickets, args.latency * 1000, args.threads)
+    )
+    print(
+        "One after the other: %.2fs (%.1f tickets/s)"
+        % (serial, args.tickets / serial)
+    )
+    print(
+        "Pipelined: %.2fs (%.1f tickets/s)"
+        % (pipelined, args.tickets / pipelined)
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
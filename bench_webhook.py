@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+from __future__ import print_function, unicode_literals
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import time
+
+
+parser = argparse.ArgumentParser(
+    description="Measure the time taken by the taiga webhook endpoint to "
+    "handle synthetic deliveries, posted to a Flask test client. The tasks "
+    "are counted rather than queued and nothing is written to the database, "
+    "the broker or redis: the project linked to taiga is only read."
+)
+parser.add_argument(
+    "--config",
+    "-c",
+    dest="config",
+    help="Configuration file to use for pagure.",
+)
+parser.add_argument(
+    "project",
+    help="Project linked to taiga the deliveries are posted for, as <repo> "
+    "or <namespace>/<repo>.",
+)
+parser.add_argument(
+    "--requests",
+    "-n",
+    dest="requests",
+    type=int,
+    default=1000,
+    help="Number of deliveries posted (defaults to 1000).",
+)
+parser.add_argument(
+    "--type",
+    dest="taiga_type",
+    choices=("issue", "userstory"),
+    default="userstory",
+    help="Type of the taiga objects of the deliveries "
+    "(defaults to userstory).",
+)
+parser.add_argument(
+    "--redis",
+    dest="redis",
+    action="store_true",
+    help="Look up the echoes of the deliveries in redis, as in production, "
+    "rather than in a local stub. The synthetic tickets never match any.",
+)
+
+args = parser.parse_args()
+
+if args.config:
+    config = args.config
+    if not config.startswith("/"):
+        here = os.path.join(os.path.dirname(os.path.abspath(__file__)))
+        config = os.path.join(here, config)
+    os.environ["PAGURE_CONFIG"] = config
+
+import flask  # noqa: E402
+
+import pagure.config  # noqa: E402
+import pagure.lib.model_base  # noqa: E402
+import pagure.lib.query  # noqa: E402
+
+from pagure_taiga import idempotency  # noqa: E402
+from pagure_taiga import metrics  # noqa: E402
+from pagure_taiga import pagure_taiga  # noqa: E402
+
+
+def make_payload(taiga_project_id, taiga_type, index):
+    """ Return a synthetic delivery of taiga's webhook: alternatively the
+    creation, a comment and a status change of a ticket.
+    """
+    ref = 100000 + index // 3
+    data = {
+        "id": ref,
+        "ref": ref,
+        "project": {"id": taiga_project_id},
+        "subject": "Benchmark ticket %s" % ref,
+        "description": "Created by bench_webhook.py",
+        "status": {"name": "New", "color": "#999999"},
+        "tags": [],
+    }
+    payload = {"type": taiga_type, "data": data}
+    if index % 3 == 0:
+        payload["action"] = "create"
+    elif index % 3 == 1:
+        payload["action"] = "change"
+        payload["change"] = {"comment": "Comment %s" % index, "diff": {}}
+    else:
+        payload["action"] = "change"
+        payload["change"] = {
+            "comment": "",
+            "diff": {"status": {"from": "New", "to": "In progress"}},
+        }
+    return payload
+
+
+class StubRedis(object):
+    """ Stands in for redis when looking up the echoes of the deliveries:
+    none of them is an echo.
+    """
+
+    def delete(self, *keys):
+        return 0
+
+
+def stub_side_effects(queued):
+    """ Count the tasks the deliveries would queue, in the given dict,
+    instead of queuing them and, unless asked otherwise, do not query
+    redis.
+    """
+
+    def apply_in_order(task, key, args, **options):
+        queued[task.name] = queued.get(task.name, 0) + 1
+
+    pagure_taiga.ordering.apply_in_order = apply_in_order
+    if not args.redis:
+        idempotency.get_redis = StubRedis
+    # The metrics of the benchmark are not sent to redis
+    pagure.config.config["PAGURE_TAIGA_METRICS_FLUSH_INTERVAL"] = float("inf")
+
+
+def percentile(values, ratio):
+    """ Return the given percentile of the given sorted values. """
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+def main():
+    if "/" in args.project:
+        namespace, reponame = args.project.split("/", 1)
+    else:
+        namespace, reponame = None, args.project
+
+    session = pagure.lib.model_base.create_session(
+        pagure.config.config["DB_URL"]
+    )
+    project = pagure.lib.query.get_authorized_project(
+        session, reponame, namespace=namespace
+    )
+    if not project or not project.taiga:
+        print("No project %s linked to taiga found" % args.project)
+        return 1
+    key = project.taiga.taiga_token
+    taiga_project_id = project.taiga.taiga_project_id
+
+    queued = {}
+    stub_side_effects(queued)
+
+    app = flask.Flask(__name__)
+    app.register_blueprint(pagure_taiga.TAIGA_NS)
+
+    @app.before_request
+    def set_session():
+        flask.g.session = session
+
+    if namespace:
+        url = "/_taiga/%s/%s/webhook" % (namespace, reponame)
+    else:
+        url = "/_taiga/%s/webhook" % reponame
+
+    # Pre-compute the bodies and their signature, only the handling of the
+    # requests is measured
+    bodies = []
+    for index in range(args.requests):
+        body = json.dumps(
+            make_payload(taiga_project_id, args.taiga_type, index)
+        ).encode("utf-8")
+        signature = hmac.new(
+            key.encode("utf-8"), body, hashlib.sha1
+        ).hexdigest()
+        bodies.append((body, signature))
+
+    durations = []
+    statuses = {}
+    with app.test_client() as test_client:
+        start = time.time()
+        for body, signature in bodies:
+            before = time.time()
+            response = test_client.post(
+                url,
+                data=body,
+                content_type="application/json",
+                headers={"X-TAIGA-WEBHOOK-SIGNATURE": signature},
+            )
+            durations.append(time.time() - before)
+            statuses[response.status_code] = (
+                statuses.get(response.status_code, 0) + 1
+            )
+        total = time.time() - start
+
+    session.remove()
+    metrics.discard()
+    durations.sort()
+    print("Deliveries: %s in %.2fs" % (len(durations), total))
+    print(
+        "Responses: %s"
+        % ", ".join(
+            "%s: %s" % (status, count)
+            for status, count in sorted(statuses.items())
+        )
+    )
+    print(
+        "Tasks not queued: %s"
+        % ", ".join(
+            "%s: %s" % (name, count) for name, count in sorted(queued.items())
+        )
+    )
+    print("p50: %.2fms" % (percentile(durations, 0.5) * 1000))
+    print("p99: %.2fms" % (percentile(durations, 0.99) * 1000))
+    print("max: %.2fms" % (durations[-1] * 1000))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
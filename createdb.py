@@ -5,10 +5,22 @@ from __future__ import print_function, unicode_literals
 import argparse
 import os
 
+import sqlalchemy as sa
 from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 import pagure.config
+import pagure.lib.model
 
-from pagure_taiga.model import BASE, PagureTaiga, PagureTaigaMapping
+from pagure_taiga.model import (
+    BASE,
+    PagureTaiga,
+    PagureTaigaComment,
+    PagureTaigaCommentDigest,
+    PagureTaigaMapping,
+    PagureTaigaOutbox,
+    TAIGA_TYPE,
+)
+from pagure_taiga.utils import hash_comment
 
 
 parser = argparse.ArgumentParser(
@@ -20,6 +32,21 @@ parser.add_argument(
     dest="config",
     help="Configuration file to use for pagure.",
 )
+parser.add_argument(
+    "--backfill-digests",
+    dest="backfill_digests",
+    action="store_true",
+    default=False,
+    help="Store the digest of the existing comments of the tickets of the "
+    "projects linked to taiga.",
+)
+parser.add_argument(
+    "--upgrade",
+    dest="upgrade",
+    action="store_true",
+    default=False,
+    help="Upgrade the schema of existing tables to the current one.",
+)
 
 args = parser.parse_args()
 
@@ -40,5 +67,106 @@ else:
 
 
 BASE.metadata.create_all(
-    engine, tables=[PagureTaiga.__table__, PagureTaigaMapping.__table__]
+    engine,
+    tables=[
+        PagureTaiga.__table__,
+        PagureTaigaMapping.__table__,
+        PagureTaigaComment.__table__,
+        PagureTaigaCommentDigest.__table__,
+        PagureTaigaOutbox.__table__,
+    ],
 )
+
+
+def add_missing_columns(table):
+    """ Add to the given table, as it exists in the database, the nullable
+    columns it is missing.
+    """
+    existing = set(
+        column["name"] for column in sa.inspect(engine).get_columns(table.name)
+    )
+    for column in table.columns:
+        if column.name not in existing and column.nullable:
+            with engine.begin() as connection:
+                connection.execute(
+                    sa.text(
+                        "ALTER TABLE %s ADD COLUMN %s %s"
+                        % (
+                            table.name,
+                            column.name,
+                            column.type.compile(dialect=engine.dialect),
+                        )
+                    )
+                )
+
+
+if args.upgrade:
+    add_missing_columns(PagureTaiga.__table__)
+    add_missing_columns(PagureTaigaMapping.__table__)
+    add_missing_columns(PagureTaigaOutbox.__table__)
+    existing = set(
+        index["name"]
+        for index in sa.inspect(engine).get_indexes(
+            PagureTaigaMapping.__tablename__
+        )
+    )
+    for index in PagureTaigaMapping.__table__.indexes:
+        if index.name not in existing:
+            index.create(engine)
+    if engine.dialect.name == "postgresql":
+        # Store the type of the taiga objects as an enum instead of a string
+        with engine.begin() as connection:
+            TAIGA_TYPE.create(connection, checkfirst=True)
+            connection.execute(
+                sa.text(
+                    "ALTER TABLE pagure_taiga_mapping "
+                    "ALTER COLUMN taiga_type TYPE pagure_taiga_type "
+                    "USING taiga_type::pagure_taiga_type"
+                )
+            )
+
+
+if args.backfill_digests:
+    session = sessionmaker(bind=engine)()
+    query = (
+        session.query(pagure.lib.model.IssueComment)
+        .join(
+            pagure.lib.model.Issue,
+            pagure.lib.model.Issue.uid
+            == pagure.lib.model.IssueComment.issue_uid,
+        )
+        .join(
+            PagureTaiga,
+            PagureTaiga.project_id == pagure.lib.model.Issue.project_id,
+        )
+        .outerjoin(
+            PagureTaigaCommentDigest,
+            PagureTaigaCommentDigest.comment_id
+            == pagure.lib.model.IssueComment.id,
+        )
+        .filter(PagureTaigaCommentDigest.id.is_(None))
+        .order_by(pagure.lib.model.IssueComment.id)
+    )
+    last_id = 0
+    while True:
+        comments = (
+            query.filter(pagure.lib.model.IssueComment.id > last_id)
+            .limit(500)
+            .all()
+        )
+        if not comments:
+            break
+        session.bulk_insert_mappings(
+            PagureTaigaCommentDigest,
+            [
+                dict(
+                    issue_uid=comment.issue_uid,
+                    comment_id=comment.id,
+                    digest=hash_comment(comment.comment),
+                )
+                for comment in comments
+            ],
+        )
+        session.commit()
+        last_id = comments[-1].id
+    session.close()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import collections
+import threading
+import time
+
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """ Small, thread-safe, in-memory cache holding at most ``maxsize``
+    entries, evicting the least recently used ones first and, if ``ttl`` is
+    set, ignoring entries older than ``ttl`` seconds.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """ Return the value stored for the given key or ``default`` if
+        there is none or if it expired.
+        """
+        with self._lock:
+            try:
+                value, stamp = self._data.pop(key)
+            except KeyError:
+                return default
+            if self.ttl is not None and time.time() - stamp > self.ttl:
+                return default
+            # Re-insert the entry so it is now the most recently used one
+            self._data[key] = (value, stamp)
+            return value
+
+    def set(self, key, value):
+        """ Store the given value for the given key, evicting the least
+        recently used entries if the cache is full.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, time.time())
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """ Remove the given key from the cache and return its value. """
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        if item is _MISSING:
+            return default
+        return item[0]
+
+    def clear(self):
+        """ Empty the cache. """
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import copy
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from urllib.parse import urlparse
+except ImportError:  # pragma: no cover
+    from urlparse import urlparse
+
+import requests
+import taiga.exceptions
+import taiga.requestmaker
+from taiga import TaigaAPI
+from taiga.models import Issue, Project, UserStory
+
+from pagure.config import config as pagure_config
+
+from pagure_taiga import metrics
+from pagure_taiga import ratelimit
+from pagure_taiga.cache import LRUCache
+
+_log = logging.getLogger(__name__)
+
+_LOCAL = threading.local()
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+_CLIENTS = LRUCache(
+    maxsize=pagure_config.get("PAGURE_TAIGA_CLIENT_POOL_SIZE", 32)
+)
+_PROJECTS = LRUCache(
+    maxsize=pagure_config.get("PAGURE_TAIGA_PROJECT_CACHE_SIZE", 256),
+    ttl=pagure_config.get("PAGURE_TAIGA_PROJECT_CACHE_TTL", 600),
+)
+
+# Fields of taiga's project document we keep in the cache
+PROJECT_FIELDS = (
+    "id",
+    "name",
+    "slug",
+    "us_statuses",
+    "issue_statuses",
+    "issue_types",
+    "priorities",
+    "severities",
+    "swimlanes",
+)
+
+# Model of each type of object the tickets of pagure are synced with
+TICKET_MODELS = {"issue": Issue, "userstory": UserStory}
+
+
+def _get_session():
+    """ Return the requests session of the current thread, creating it if
+    needed.
+    """
+    session = getattr(_LOCAL, "session", None)
+    if session is None:
+        session = requests.Session()
+        _LOCAL.session = session
+    return session
+
+
+class TaigaUnavailable(taiga.exceptions.TaigaRestException):
+    """ Raised when taiga asks us to slow down or is unavailable. """
+
+    def __init__(self, *args, **kwargs):
+        self.retry_after = kwargs.pop("retry_after", None)
+        super(TaigaUnavailable, self).__init__(*args, **kwargs)
+
+
+class _SessionRequests(object):
+    """ Stand-in for the ``requests`` module as used by python-taiga which
+    sends every request through the persistent session of the current
+    thread, so connections to taiga are kept alive and re-used from one
+    task to another instead of being re-opened for every request.
+    """
+
+    packages = requests.packages
+    exceptions = requests.exceptions
+
+    def request(self, method, url, **kwargs):
+        parsed = urlparse(url)
+        host = parsed.netloc
+        wait = ratelimit.acquire(host)
+        if wait:
+            # Let celery retry the task later rather than holding the worker
+            raise TaigaUnavailable(
+                url,
+                None,
+                "Rate-limited for %.1fs" % wait,
+                method,
+                retry_after=wait,
+            )
+        endpoint = metrics.get_endpoint(parsed.path)
+        start = time.time()
+        try:
+            response = _get_session().request(method, url, **kwargs)
+        except requests.exceptions.RequestException as err:
+            metrics.HTTP_REQUESTS.inc(
+                endpoint=endpoint, method=method, status="error"
+            )
+            # python-taiga turns any of these into a 400 "Network error!"
+            if isinstance(
+                err,
+                (
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                ),
+            ):
+                raise TaigaUnavailable(url, None, str(err), method)
+            raise
+        finally:
+            metrics.HTTP_DURATION.observe(
+                time.time() - start, endpoint=endpoint, method=method
+            )
+        metrics.HTTP_REQUESTS.inc(
+            endpoint=endpoint, method=method, status=response.status_code
+        )
+        # python-taiga raises the same exception for any error up to 500
+        # included, these are worth retrying
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = response.headers.get("Retry-After")
+            if (retry_after or "").isdigit():
+                retry_after = int(retry_after)
+            else:
+                retry_after = None
+            # Only back off from the whole instance when it says it is
+            # overloaded, other errors may only concern this request
+            if response.status_code in (429, 503) or retry_after is not None:
+                retry_after = ratelimit.back_off(host, retry_after)
+            raise TaigaUnavailable(
+                url,
+                response.status_code,
+                response.text,
+                method,
+                retry_after=retry_after,
+            )
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+# python-taiga calls requests.get/post/... directly, each of these creating
+# (and closing) its own connection.
+taiga.requestmaker.requests = _SessionRequests()
+
+
+def get_api(taiga_config):
+    """ Return a TaigaAPI client for the specified PagureTaiga object.
+
+    Clients are pooled per process and keyed on the taiga instance and the
+    token used, so changing either of them in the settings automatically
+    leads to a new client being used.
+    """
+    key = (taiga_config.taiga_url, taiga_config.taiga_token)
+    api = _CLIENTS.get(key)
+    if api is None:
+        _log.debug("Creating a new taiga client for %s", key[0])
+        api = TaigaAPI(token=key[1], host=key[0])
+        _CLIENTS.set(key, api)
+    return api
+
+
+def invalidate_api(taiga_url, taiga_token):
+    """ Drop the pooled client for the specified taiga instance and token
+    if there is one.
+    """
+    _CLIENTS.pop((taiga_url, taiga_token))
+
+
+def _fetch_project(api, taiga_config):
+    """ Retrieve from taiga the metadata of the project linked to the
+    specified PagureTaiga object.
+    """
+    if taiga_config.taiga_project_id:
+        response = api.raw_request.get(
+            "/{endpoint}/{id}",
+            endpoint=Project.endpoint,
+            id=taiga_config.taiga_project_id,
+        )
+    else:
+        response = api.raw_request.get(
+            "/{endpoint}/by_slug?slug={slug}",
+            endpoint=Project.endpoint,
+            slug=taiga_config.project_name,
+        )
+    data = response.json()
+    return dict((key, data.get(key)) for key in PROJECT_FIELDS)
+
+
+def _build_status_index(statuses):
+    """ Return a dict mapping the name of each of the given statuses to a
+    tuple of its order and identifier.
+    """
+    return dict(
+        (status["name"], (status["order"], status["id"]))
+        for status in statuses or []
+    )
+
+
+def _get_project_entry(api, taiga_config, refresh=False):
+    """ Return the cached entry for the project linked to the specified
+    PagureTaiga object, retrieving it from taiga if needed.
+    """
+    key = taiga_config.taiga_project_id or taiga_config.project_name
+    entry = None if refresh else _PROJECTS.get(key)
+    if entry is None:
+        _log.debug("Retrieving the taiga project %s", key)
+        data = _fetch_project(api, taiga_config)
+        entry = {
+            "project": data,
+            "statuses": {
+                "userstory": _build_status_index(data["us_statuses"]),
+                "issue": _build_status_index(data["issue_statuses"]),
+            },
+        }
+        _PROJECTS.set(key, entry)
+    return entry
+
+
+def get_project(api, taiga_config, refresh=False):
+    """ Return the taiga Project linked to the specified PagureTaiga object.
+
+    The project's metadata (id, statuses, issue types, priorities and
+    severities) are cached per process for PAGURE_TAIGA_PROJECT_CACHE_TTL
+    seconds, so most tasks do not need to query taiga for them.
+    """
+    data = _get_project_entry(api, taiga_config, refresh=refresh)["project"]
+    # python-taiga changes the data it parses in place
+    return Project.parse(api.raw_request, copy.deepcopy(data))
+
+
+def get_status_index(api, taiga_config, taiga_type):
+    """ Return a dict mapping the name of the statuses available for the
+    specified type of object (issue or userstory) in the taiga project
+    linked to the specified PagureTaiga object to a tuple of their order
+    and identifier.
+    """
+    return _get_project_entry(api, taiga_config)["statuses"][taiga_type]
+
+
+def has_swimlanes(api, taiga_config):
+    """ Return whether the taiga project linked to the specified PagureTaiga
+    object has swimlanes in its kanban board.
+    """
+    return bool(_get_project_entry(api, taiga_config)["project"]["swimlanes"])
+
+
+def check_status(taiga_project_id, taiga_type, status_name):
+    """ Drop the cached metadata of the specified taiga project if the
+    given status is not known to it, ie: if the statuses of the project
+    have changed since they were cached.
+    """
+    entry = _PROJECTS.get(taiga_project_id)
+    if entry and status_name not in entry["statuses"][taiga_type]:
+        _log.debug("Status %s unknown, refreshing the cache", status_name)
+        invalidate_project(taiga_project_id)
+
+
+def invalidate_project(taiga_project_id):
+    """ Drop the cached metadata of the specified taiga project. """
+    _PROJECTS.pop(taiga_project_id)
+
+
+def get_ticket_data(
+    api, taiga_type, object_id=None, taiga_project_id=None, ref=None
+):
+    """ Return the document of the issue or user story (depending on the
+    specified type) having the given identifier or, if it is not known, the
+    given reference in the specified taiga project.
+    """
+    endpoint = TICKET_MODELS[taiga_type].endpoint
+    if object_id is not None:
+        response = api.raw_request.get(
+            "/{endpoint}/{id}", endpoint=endpoint, id=object_id
+        )
+    else:
+        response = api.raw_request.get(
+            "/{endpoint}/by_ref?ref={ref}&project={project_id}",
+            endpoint=endpoint,
+            ref=ref,
+            project_id=taiga_project_id,
+        )
+    return response.json()
+
+
+def get_ticket(api, taiga_type, **kwargs):
+    """ Return the issue or user story (depending on the specified type)
+    looked up as by get_ticket_data.
+    """
+    return TICKET_MODELS[taiga_type].parse(
+        api.raw_request, get_ticket_data(api, taiga_type, **kwargs)
+    )
+
+
+def delete_ticket(api, taiga_type, object_id):
+    """ Delete the issue or user story (depending on the specified type)
+    having the given identifier.
+    """
+    api.raw_request.delete(
+        "/{endpoint}/{id}",
+        endpoint=TICKET_MODELS[taiga_type].endpoint,
+        id=object_id,
+    )
+
+
+def bulk_update_status(api, taiga_project_id, status_id, userstory_ids):
+    """ Move the given user stories of the specified taiga project to the
+    given status, in a single request.
+
+    This relies on the bulk_update_kanban_order endpoint as it is since
+    taiga 6, older versions reject the request. That endpoint is the one of
+    the kanban board: it also moves the user stories out of their swimlane
+    and rewrites their kanban order, placing them together in the column of
+    the status, so it is only used for projects without swimlanes.
+    """
+    api.raw_request.post(
+        "/{endpoint}/bulk_update_kanban_order",
+        endpoint=UserStory.endpoint,
+        payload={
+            "project_id": taiga_project_id,
+            "status_id": status_id,
+            "bulk_userstories": userstory_ids,
+        },
+    )
+
+
+def iter_tickets(api, taiga_project_id, taiga_type, page_size=100, **filters):
+    """ Yields the issues or user stories of the specified taiga project,
+    optionally filtered, retrieving them page by page.
+    """
+    endpoint = TICKET_MODELS[taiga_type].endpoint
+    query = dict(filters, project=taiga_project_id, page_size=page_size)
+    page = 1
+    while page:
+        query["page"] = page
+        response = api.raw_request.get(
+            "/{endpoint}", endpoint=endpoint, query=query
+        )
+        for ticket in response.json():
+            yield ticket
+        if response.headers.get("X-Pagination-Next"):
+            page += 1
+        else:
+            page = None
+
+
+def map_concurrently(function, items):
+    """ Return the list of the results of the given function, expected to
+    be mostly waiting on taiga, called on each of the given items, running
+    up to PAGURE_TAIGA_LOOKUP_THREADS of these calls at once.
+
+    Each thread has its own connections to taiga and all the requests go
+    through the rate limiter, as the requests of the tasks do.
+    """
+    global _EXECUTOR
+    items = list(items)
+    threads = pagure_config.get("PAGURE_TAIGA_LOOKUP_THREADS", 8)
+    if threads <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=threads)
+    return list(_EXECUTOR.map(function, items))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import logging
+
+import redis
+
+from pagure.config import config as pagure_config
+
+from pagure_taiga import metrics
+from pagure_taiga.cache import LRUCache
+from pagure_taiga.utils import get_redis, hash_comment
+
+_log = logging.getLogger(__name__)
+
+
+# Every change pagure-taiga makes on one side comes back as an event from
+# that side (a webhook from taiga, a signal from pagure). The changes we make
+# are recorded here, before being made, so their echo can be dropped as soon
+# as it is received instead of being queued only to be found to be a no-op.
+ECHO_KEY = "pagure_taiga:echo:%s"
+
+# Process-local copy of the changes recorded, recognizing the echoes
+# received by the process which made the change even if redis is unavailable
+_ECHOES = LRUCache(
+    maxsize=pagure_config.get("PAGURE_TAIGA_ECHO_CACHE_SIZE", 4096),
+    ttl=pagure_config.get("PAGURE_TAIGA_ECHO_TTL", 600),
+)
+
+
+def _fingerprint(parts):
+    """ Return the key identifying the change described by the given
+    parts.
+    """
+    return ":".join("%s" % part for part in parts)
+
+
+def record(*parts):
+    """ Record that pagure-taiga is about to make the change described by
+    the given parts, so its echo is recognized by is_echo.
+    """
+    key = _fingerprint(parts)
+    _ECHOES.set(key, True)
+    try:
+        get_redis().set(
+            ECHO_KEY % key,
+            1,
+            ex=pagure_config.get("PAGURE_TAIGA_ECHO_TTL", 600),
+        )
+    except redis.RedisError:
+        _log.exception("Could not record the change %s", key)
+
+
+def is_echo(parts):
+    """ Return whether the change described by the given parts was made by
+    pagure-taiga itself. A change is only recognized once, as it is only
+    echoed once.
+    """
+    if not parts:
+        return False
+    key = _fingerprint(parts)
+    local = _ECHOES.pop(key) is not None
+    try:
+        # Removed even when found locally, otherwise the same change made
+        # afterwards by another process would be taken for an echo
+        echo = bool(get_redis().delete(ECHO_KEY % key)) or local
+    except redis.RedisError:
+        _log.exception("Could not look up the change %s", key)
+        echo = local
+    metrics.ECHOES.inc(result="hit" if echo else "miss")
+    if echo:
+        _log.debug("Dropping the echo of the change %s", key)
+    return echo
+
+
+def taiga_change(data):
+    """ Return the parts describing the change notified by taiga's webhook,
+    as compacted by ingest.compact_payload, or None if it is not a change
+    pagure-taiga makes.
+    """
+    if data["action"] == "create":
+        return (
+            "taiga",
+            data["type"],
+            data["project_id"],
+            "create",
+            hash_comment(data["subject"] or ""),
+        )
+    base = ("taiga", data["type"], data["project_id"], data["ref"])
+    if data["action"] == "delete":
+        return base + ("delete",)
+    elif data["action"] == "change":
+        if data["comment"]:
+            return base + ("comment", hash_comment(data["comment"]))
+        elif data["status_to"]:
+            return base + ("status", data["status_to"])
+
+
+def pagure_change(topic, message):
+    """ Return the parts describing the change notified by pagure's signal,
+    or None if it is not a change pagure-taiga makes.
+    """
+    if topic not in (
+        "issue.new",
+        "issue.drop",
+        "issue.comment.added",
+        "issue.tag.added",
+    ):
+        return None
+    base = ("pagure", message["project"]["id"], message["issue"]["id"])
+    if topic == "issue.new":
+        return base + ("new",)
+    elif topic == "issue.drop":
+        return base + ("drop",)
+    elif topic == "issue.comment.added":
+        comment = message["issue"]["comments"][-1]["comment"]
+        return base + ("comment", hash_comment(comment))
+    return base + ("tags", ",".join(sorted(message["tags"])))
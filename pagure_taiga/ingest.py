@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import hashlib
+import hmac
+
+
+# Types of taiga objects synced with pagure
+SUPPORTED_TYPES = ("issue", "userstory")
+
+
+class InvalidPayload(ValueError):
+    """ Raised when the payload sent by taiga's webhook is invalid. """
+
+
+def verify_signature(key, body, signature):
+    """ Return whether the given signature, sent by taiga in the
+    X-TAIGA-WEBHOOK-SIGNATURE header, is the HMAC-SHA1 of the given raw body
+    with the given key. The comparison is made in constant time.
+    """
+    if not key or not signature:
+        return False
+    expected = hmac.new(key.encode("utf-8"), body, hashlib.sha1).hexdigest()
+    return hmac.compare_digest(
+        expected.encode("ascii"), signature.encode("utf-8")
+    )
+
+
+def _get_field(value, key):
+    """ Return the given key of the given value if it is an object, as
+    taiga sends users and milestones, or the value itself otherwise.
+    """
+    if isinstance(value, dict):
+        return value.get(key)
+    return value
+
+
+def compact_payload(payload):
+    """ Validate the payload sent by taiga's webhook and return a compact
+    record of the fields pagure-taiga uses, so the full document (with its
+    user, project and status sub-objects) is not what gets queued.
+
+    The record is a flat dict with the following keys: action, type,
+    project_id, id, ref, subject, description, status, status_color, tags,
+    assigned_to, milestone, comment, comment_edited, comment_deleted,
+    status_from and status_to. Only action and type are set for objects
+    whose type is not synced with pagure.
+    """
+    if not isinstance(payload, dict):
+        raise InvalidPayload("The payload is not a JSON object")
+
+    try:
+        record = {"action": payload["action"], "type": payload["type"]}
+        if record["type"] not in SUPPORTED_TYPES:
+            return record
+
+        data = payload["data"]
+        status = data.get("status") or {}
+        change = payload.get("change") or {}
+        status_diff = (change.get("diff") or {}).get("status") or {}
+        record.update(
+            {
+                "project_id": int(data["project"]["id"]),
+                "id": int(data["id"]),
+                "ref": int(data["ref"]),
+                "subject": data.get("subject"),
+                "description": data.get("description") or "",
+                "status": status.get("name"),
+                "status_color": status.get("color"),
+                "tags": list(data.get("tags") or []),
+                "assigned_to": _get_field(data.get("assigned_to"), "username"),
+                "milestone": _get_field(data.get("milestone"), "name"),
+                "comment": change.get("comment") or None,
+                "comment_edited": bool(change.get("edit_comment_date")),
+                "comment_deleted": bool(change.get("delete_comment_date")),
+                "status_from": status_diff.get("from"),
+                "status_to": status_diff.get("to"),
+            }
+        )
+    except (AttributeError, KeyError, TypeError, ValueError) as err:
+        raise InvalidPayload("Invalid payload, missing or invalid: %s" % err)
+    return record
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import atexit
+import calendar
+import collections
+import logging
+import re
+import threading
+import time
+
+from wsgiref.simple_server import make_server
+
+import redis
+import sqlalchemy as sa
+from celery import signals
+from celery.utils.time import maybe_iso8601
+
+from pagure.config import config as pagure_config
+
+from pagure_taiga.utils import get_redis
+
+_log = logging.getLogger(__name__)
+
+
+# The metrics of all the pagure-taiga processes (web and workers) are
+# aggregated in redis, one hash per metric, so any of them can render them.
+# Each process buffers its observations and only sends them to redis every
+# PAGURE_TAIGA_METRICS_FLUSH_INTERVAL seconds.
+METRIC_KEY = "pagure_taiga:metrics:%s"
+ENQUEUED_HEADER = "pagure_taiga_enqueued_at"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_REGISTRY = collections.OrderedDict()
+_PENDING = collections.defaultdict(float)
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_LAST_FLUSH = [time.time()]
+
+
+def _format_labels(labelnames, labels):
+    """ Return the given labels in the format used by prometheus. """
+    return ",".join(
+        '%s="%s"'
+        % (
+            name,
+            ("%s" % labels[name])
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name in labelnames
+    )
+
+
+def _add(name, field, value):
+    """ Add the given value to the given field of the given metric. """
+    with _LOCK:
+        _PENDING[(name, field)] += value
+    interval = pagure_config.get("PAGURE_TAIGA_METRICS_FLUSH_INTERVAL", 10)
+    if time.time() - _LAST_FLUSH[0] >= interval:
+        flush()
+
+
+def flush():
+    """ Send the observations buffered in this process to redis. """
+    with _LOCK:
+        pending = dict(_PENDING)
+        _PENDING.clear()
+        _LAST_FLUSH[0] = time.time()
+    if not pending:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for (name, field), value in pending.items():
+            pipe.hincrbyfloat(METRIC_KEY % name, field, value)
+        pipe.execute()
+    except redis.RedisError:
+        _log.exception("Could not store %s metrics", len(pending))
+
+
+atexit.register(flush)
+
+
+def discard():
+    """ Drop the observations buffered in this process without sending
+    them to redis.
+    """
+    with _LOCK:
+        _PENDING.clear()
+
+
+class Counter(object):
+    """ Metric counting how many times something happened. """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        _REGISTRY[name] = self
+
+    def inc(self, value=1, **labels):
+        _add(self.name, _format_labels(self.labelnames, labels), value)
+
+    def render(self, values):
+        for labels, value in sorted(values.items()):
+            if labels:
+                yield "%s{%s} %s" % (self.name, labels, value)
+            else:
+                yield "%s %s" % (self.name, value)
+
+
+class Histogram(object):
+    """ Metric counting the observed values in buckets. """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets or DEFAULT_BUCKETS) + (float("inf"),)
+        _REGISTRY[name] = self
+
+    def observe(self, value, **labels):
+        labels = _format_labels(self.labelnames, labels)
+        for bucket in self.buckets:
+            if value <= bucket:
+                break
+        _add(self.name, "bucket:%s|%s" % (bucket, labels), 1)
+        _add(self.name, "sum|%s" % labels, value)
+        _add(self.name, "count|%s" % labels, 1)
+
+    def _le(self, labels, bucket):
+        le = "+Inf" if bucket == float("inf") else "%s" % bucket
+        return ",".join(filter(None, [labels, 'le="%s"' % le]))
+
+    def render(self, values):
+        series = collections.defaultdict(dict)
+        for field, value in values.items():
+            kind, labels = field.split("|", 1)
+            series[labels][kind] = value
+        for labels, fields in sorted(series.items()):
+            total = 0
+            for bucket in self.buckets:
+                total += fields.get("bucket:%s" % bucket, 0)
+                yield "%s_bucket{%s} %s" % (
+                    self.name,
+                    self._le(labels, bucket),
+                    total,
+                )
+            suffix = "{%s}" % labels if labels else ""
+            yield "%s_sum%s %s" % (self.name, suffix, fields.get("sum", 0))
+            yield "%s_count%s %s" % (self.name, suffix, fields.get("count", 0))
+
+
+def render():
+    """ Return all the metrics, aggregated over all the pagure-taiga
+    processes, in prometheus' text format.
+    """
+    flush()
+    pipe = get_redis().pipeline(transaction=False)
+    for name in _REGISTRY:
+        pipe.hgetall(METRIC_KEY % name)
+    lines = []
+    for metric, values in zip(_REGISTRY.values(), pipe.execute()):
+        lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+        lines.append("# TYPE %s %s" % (metric.name, metric.type))
+        lines.extend(
+            metric.render(
+                dict(
+                    (field.decode("utf-8"), float(value))
+                    for field, value in values.items()
+                )
+            )
+        )
+    return "\n".join(lines) + "\n"
+
+
+def start_http_server(port, address=""):
+    """ Serve the metrics, in a background thread, on the given port. """
+
+    def application(environ, start_response):
+        start_response(
+            str("200 OK"),
+            [(str("Content-Type"), str("text/plain; version=0.0.4"))],
+        )
+        return [render().encode("utf-8")]
+
+    server = make_server(address, port, application)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+EVENTS_RECEIVED = Counter(
+    "pagure_taiga_events_received_total",
+    "Events received from pagure's signal and taiga's webhook.",
+    ("source", "event"),
+)
+WEBHOOKS_REJECTED = Counter(
+    "pagure_taiga_webhooks_rejected_total",
+    "Deliveries of taiga's webhook rejected before being queued.",
+    ("reason",),
+)
+ECHOES = Counter(
+    "pagure_taiga_echoes_total",
+    "Events looked up as echoes of our own changes.",
+    ("result",),
+)
+COALESCED_EVENTS = Counter(
+    "pagure_taiga_coalesced_events_total",
+    "Events synced to taiga along with other events of the same ticket.",
+)
+BULK_STATUS_CHANGES = Counter(
+    "pagure_taiga_bulk_status_changes_total",
+    "Status changes of user stories sent to taiga in bulk or one by one.",
+    ("mode",),
+)
+DIVERGENCES = Counter(
+    "pagure_taiga_reconcile_divergences_total",
+    "Divergences between pagure and taiga found by the reconciliation.",
+    ("kind",),
+)
+OUTBOX_RELAYED = Counter(
+    "pagure_taiga_outbox_relayed_total",
+    "Events relayed from the outbox to celery.",
+)
+OUTBOX_LAG = Histogram(
+    "pagure_taiga_outbox_lag_seconds",
+    "Time the events waited in the outbox.",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900),
+)
+ORDERING_WAITS = Counter(
+    "pagure_taiga_ordering_waits_total",
+    "Tasks re-queued to wait for the previous task of their ticket.",
+)
+ORDERING_TIMEOUTS = Counter(
+    "pagure_taiga_ordering_timeouts_total",
+    "Tasks run after waiting too long for the previous task of their ticket.",
+)
+TASKS = Counter(
+    "pagure_taiga_tasks_total",
+    "Tasks enqueued, succeeded, failed and retried.",
+    ("task", "state"),
+)
+TASK_DURATION = Histogram(
+    "pagure_taiga_task_duration_seconds",
+    "Time spent running the tasks.",
+    ("task",),
+)
+QUEUE_LAG = Histogram(
+    "pagure_taiga_queue_lag_seconds",
+    "Time the tasks waited in the queue once due.",
+    ("task",),
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900),
+)
+DB_QUERIES = Histogram(
+    "pagure_taiga_db_queries_per_task",
+    "Database queries made by the tasks.",
+    ("task",),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 250),
+)
+HTTP_REQUESTS = Counter(
+    "pagure_taiga_http_requests_total",
+    "Requests sent to taiga.",
+    ("endpoint", "method", "status"),
+)
+HTTP_DURATION = Histogram(
+    "pagure_taiga_http_request_duration_seconds",
+    "Time taken by the requests sent to taiga.",
+    ("endpoint", "method"),
+)
+
+
+def get_endpoint(path):
+    """ Return the endpoint of taiga's API corresponding to the given path,
+    the identifiers in it replaced so the number of endpoints is bounded.
+    """
+    return re.sub(r"/\d+(?=/|$)", "/{id}", path)
+
+
+def _is_ours(name):
+    return (name or "").startswith("pagure_taiga.")
+
+
+@signals.before_task_publish.connect
+def _on_publish(sender=None, headers=None, **kwargs):
+    if _is_ours(sender):
+        if headers is not None:
+            headers[ENQUEUED_HEADER] = time.time()
+        TASKS.inc(task=sender, state="enqueued")
+
+
+@signals.task_prerun.connect
+def _on_prerun(sender=None, task=None, **kwargs):
+    if not _is_ours(task.name):
+        return
+    now = time.time()
+    _LOCAL.started = now
+    _LOCAL.queries = 0
+    due = getattr(task.request, ENQUEUED_HEADER, None)
+    if due is not None:
+        if task.request.eta:
+            eta = maybe_iso8601(task.request.eta)
+            due = max(due, calendar.timegm(eta.utctimetuple()))
+        QUEUE_LAG.observe(max(now - due, 0), task=task.name)
+
+
+@signals.task_postrun.connect
+def _on_postrun(sender=None, task=None, **kwargs):
+    started = getattr(_LOCAL, "started", None)
+    if not _is_ours(task.name) or started is None:
+        return
+    TASK_DURATION.observe(time.time() - started, task=task.name)
+    DB_QUERIES.observe(_LOCAL.queries, task=task.name)
+    _LOCAL.started = None
+    flush()
+
+
+@signals.task_success.connect
+def _on_success(sender=None, **kwargs):
+    if _is_ours(sender.name):
+        TASKS.inc(task=sender.name, state="succeeded")
+
+
+@signals.task_failure.connect
+def _on_failure(sender=None, **kwargs):
+    if _is_ours(sender.name):
+        TASKS.inc(task=sender.name, state="failed")
+
+
+@signals.task_retry.connect
+def _on_retry(sender=None, **kwargs):
+    if _is_ours(sender.name):
+        TASKS.inc(task=sender.name, state="retried")
+
+
+@sa.event.listens_for(sa.engine.Engine, "before_cursor_execute")
+def _on_query(*args, **kwargs):
+    if getattr(_LOCAL, "started", None) is not None:
+        _LOCAL.queries += 1
@@ -10,6 +10,7 @@
 
 from __future__ import unicode_literals, print_function
 
+import datetime
 import logging
 import sqlalchemy as sa
 
@@ -25,6 +26,8 @@ _log = logging.getLogger(__name__)
 
 # DB Model
 
+TAIGA_TYPE = sa.Enum("issue", "userstory", name="pagure_taiga_type")
+
 
 class PagureTaiga(BASE):
     """ Stores information about a taiga project linked to a pagure one.
@@ -51,6 +54,8 @@ class PagureTaiga(BASE):
     taiga_project_id = sa.Column(
         sa.Integer, nullable=True, unique=True, index=True
     )
+    # Time up to which the changes of the project were reconciled
+    reconciled_at = sa.Column(sa.DateTime, nullable=True)
 
     project = relation(
         "Project",
@@ -75,6 +80,12 @@ class PagureTaigaMapping(BASE):
     __tablename__ = "pagure_taiga_mapping"
     __table_args__ = (
         sa.UniqueConstraint("taiga_project", "pagure_ticket_id", "taiga_type"),
+        sa.Index(
+            "pagure_taiga_mapping_taiga_idx",
+            "taiga_project",
+            "taiga_id",
+            "taiga_type",
+        ),
     )
 
     id = sa.Column(sa.Integer, primary_key=True)
@@ -90,4 +101,97 @@ class PagureTaigaMapping(BASE):
     )
     taiga_id = sa.Column(sa.Integer, nullable=False, index=True)
     pagure_ticket_id = sa.Column(sa.Integer, nullable=False, index=True)
-    taiga_type = sa.Column(sa.String(255), nullable=False)
+    taiga_type = sa.Column(TAIGA_TYPE, nullable=False)
+    # Identifier of the issue/user story in taiga, taiga_id being its
+    # reference. Unknown for the mappings created before it was stored.
+    taiga_object_id = sa.Column(sa.Integer, nullable=True)
+    # Whether all the comments synced for this mapping are recorded in
+    # pagure_taiga_comment. Not the case for the mappings created before the
+    # comments were recorded, until they are reconciled.
+    comments_recorded = sa.Column(sa.Boolean, nullable=True)
+
+
+class PagureTaigaComment(BASE):
+    """ Stores the comments synced between a ticket in pagure and its
+    corresponding issue/user story in taiga, allowing to check if a comment
+    was already synced without going through the whole history of the
+    ticket in taiga.
+
+    The comments are identified, on taiga's side, by the hash of their
+    content: neither the response to adding a comment nor taiga's webhook
+    carry the identifier of the history entry holding it.
+
+    Table -- pagure_taiga_comment
+    """
+
+    __tablename__ = "pagure_taiga_comment"
+    __table_args__ = (
+        sa.Index("pagure_taiga_comment_hash", "mapping_id", "comment_hash"),
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    mapping_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey(
+            "pagure_taiga_mapping.id", onupdate="CASCADE", ondelete="CASCADE"
+        ),
+        nullable=False,
+    )
+    pagure_comment_id = sa.Column(sa.Integer, nullable=True)
+    comment_hash = sa.Column(sa.String(64), nullable=False)
+
+    mapping = relation(
+        "PagureTaigaMapping",
+        backref=backref("comments", cascade="delete, delete-orphan"),
+    )
+
+
+class PagureTaigaCommentDigest(BASE):
+    """ Stores the digest of the comments synced on the tickets in pagure,
+    allowing to find a comment from its content with a simple index lookup.
+
+    Table -- pagure_taiga_comment_digest
+    """
+
+    __tablename__ = "pagure_taiga_comment_digest"
+    __table_args__ = (
+        sa.Index("pagure_taiga_comment_digest_idx", "issue_uid", "digest"),
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    issue_uid = sa.Column(
+        sa.String(32),
+        sa.ForeignKey("issues.uid", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False,
+    )
+    comment_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey(
+            "issue_comments.id", onupdate="CASCADE", ondelete="CASCADE"
+        ),
+        nullable=False,
+        unique=True,
+    )
+    digest = sa.Column(sa.String(64), nullable=False)
+
+
+class PagureTaigaOutbox(BASE):
+    """ Stores the events of pagure to sync to taiga, written in the same
+    transaction as the change they notify and relayed to celery by the
+    relay_outbox task.
+
+    Table -- pagure_taiga_outbox
+    """
+
+    __tablename__ = "pagure_taiga_outbox"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    topic = sa.Column(sa.String(255), nullable=False)
+    message = sa.Column(sa.Text, nullable=False)
+    correlation_id = sa.Column(sa.String(32), nullable=True)
+    date_created = sa.Column(
+        sa.DateTime, nullable=False, default=datetime.datetime.utcnow
+    )
+    # Number of times relaying the event failed, the events failing
+    # PAGURE_TAIGA_OUTBOX_MAX_ATTEMPTS times are set aside
+    attempts = sa.Column(sa.Integer, nullable=True, default=0)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import functools
+import logging
+import time
+
+import redis
+from celery.exceptions import Retry
+
+from pagure.config import config as pagure_config
+
+from pagure_taiga import metrics
+from pagure_taiga.utils import get_redis
+
+_log = logging.getLogger(__name__)
+
+
+# The tasks concerning a ticket are numbered, per ticket, when queued and
+# each of them only runs once the one before it is done. A task whose turn
+# has not come yet is queued again, at the end of the queue, so it does not
+# hold a worker while the tasks of the other tickets keep running.
+SEQUENCE_KEY = "pagure_taiga:ordering:%s:sequence"
+DONE_KEY = "pagure_taiga:ordering:%s:done"
+KEYS_TTL = 86400
+
+# Only ever move the number of the last task done forward, the tasks being
+# marked as done out of order when one of them timed out
+_DONE_SCRIPT = """
+local done = tonumber(redis.call("GET", KEYS[1]) or 0)
+if done < tonumber(ARGV[1]) then
+    redis.call("SET", KEYS[1], ARGV[1], "EX", ARGV[2])
+end
+"""
+
+_SCRIPT = None
+
+
+def pagure_key(message):
+    """ Return the ordering key of the pagure ticket concerned by the given
+    message sent by pagure.
+    """
+    return "pagure:%s:%s" % (message["project"]["id"], message["issue"]["id"])
+
+
+def taiga_key(taiga_data):
+    """ Return the ordering key of the taiga ticket of the given record, as
+    built by ingest.compact_payload.
+    """
+    return "taiga:%s:%s:%s" % (
+        taiga_data["project_id"],
+        taiga_data["type"],
+        taiga_data["ref"],
+    )
+
+
+def apply_in_order(task, key, args, **options):
+    """ Queue the given task so it only runs once the tasks queued before it
+    with the same ordering key are done.
+
+    A task concerning several tickets is given the list of their keys and
+    only runs once the tasks queued before it for any of them are done.
+    """
+    keys = key if isinstance(key, (list, tuple)) else [key]
+    try:
+        # The task is numbered for all its keys at once (the pipeline is a
+        # transaction), so two tasks sharing keys are in the same order for
+        # all of them and never wait for each other
+        pipe = get_redis().pipeline()
+        for entry in keys:
+            pipe.incr(SEQUENCE_KEY % entry)
+            pipe.expire(SEQUENCE_KEY % entry, KEYS_TTL)
+        sequences = pipe.execute()[::2]
+    except redis.RedisError:
+        _log.exception("Could not number the task for %s", key)
+        return task.apply_async(args=args, **options)
+    now = time.time()
+    ordering = [[entry, seq, now] for entry, seq in zip(keys, sequences)]
+    if not isinstance(key, (list, tuple)):
+        ordering = ordering[0]
+    return task.apply_async(
+        args=args, kwargs={"ordering": ordering}, **options
+    )
+
+
+def _is_turn(key, sequence, queued_at):
+    """ Return whether the task of the given sequence number can run. """
+    try:
+        done = int(get_redis().get(DONE_KEY % key) or 0)
+    except redis.RedisError:
+        _log.exception("Could not check the order of the tasks of %s", key)
+        return True
+    if sequence <= done + 1:
+        return True
+    timeout = pagure_config.get("PAGURE_TAIGA_ORDERING_TIMEOUT", 300)
+    if time.time() - queued_at > timeout:
+        _log.warning(
+            "Task %s of %s waited for task %s for more than %ss, running it",
+            sequence,
+            key,
+            done + 1,
+            timeout,
+        )
+        metrics.ORDERING_TIMEOUTS.inc()
+        return True
+    return False
+
+
+def _mark_done(key, sequence):
+    """ Record that the task of the given sequence number is done. """
+    global _SCRIPT
+    try:
+        if _SCRIPT is None:
+            _SCRIPT = get_redis().register_script(_DONE_SCRIPT)
+        _SCRIPT(keys=[DONE_KEY % key], args=[sequence, KEYS_TTL])
+    except redis.RedisError:
+        _log.exception("Could not mark task %s of %s as done", sequence, key)
+
+
+def ordered(function):
+    """ Decorator running the decorated task, when queued by apply_in_order,
+    only once the tasks queued before it for the same tickets are done.
+    """
+
+    @functools.wraps(function)
+    def decorated_function(self, *args, **kwargs):
+        ordering = kwargs.pop("ordering", None)
+        if ordering is None:
+            return function(self, *args, **kwargs)
+
+        # Tasks concerning several tickets have one entry per ticket
+        entries = ordering if isinstance(ordering[0], list) else [ordering]
+        waiting = next(
+            (entry for entry in entries if not _is_turn(*entry)), None
+        )
+        if waiting is not None:
+            key, sequence, _ = waiting
+            _log.debug("Task %s of %s not due yet, re-queuing", sequence, key)
+            metrics.ORDERING_WAITS.inc()
+            self.apply_async(
+                args=args,
+                kwargs=dict(kwargs, ordering=ordering),
+                task_id=self.request.id,
+                countdown=pagure_config.get("PAGURE_TAIGA_ORDERING_DELAY", 1),
+            )
+            return
+
+        try:
+            result = function(self, *args, **kwargs)
+        except Retry:
+            # Retried: the tasks after this one keep waiting for it
+            raise
+        except Exception:
+            for key, sequence, _ in entries:
+                _mark_done(key, sequence)
+            raise
+        for key, sequence, _ in entries:
+            _mark_done(key, sequence)
+        return result
+
+    return decorated_function
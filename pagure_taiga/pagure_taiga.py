@@ -10,23 +10,47 @@
 
 from __future__ import unicode_literals, print_function
 import logging
-import time
 
 import flask
 import blinker
 import wtforms
 
+import sqlalchemy as sa
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 import taiga
 import taiga.exceptions
 
+import pagure.config
 import pagure.forms
+import pagure.lib.model
 
+from pagure_taiga import client
+from pagure_taiga import idempotency
+from pagure_taiga import ingest
+from pagure_taiga import metrics
 from pagure_taiga import model
+from pagure_taiga import ordering
 from pagure_taiga import query
+from pagure_taiga.cache import LRUCache
+from pagure_taiga.utils import new_correlation_id
 
 _log = logging.getLogger(__name__)
 
+# Web-process cache of the keys signing the webhooks, per (namespace, repo)
+_WEBHOOK_KEYS = LRUCache(
+    maxsize=pagure.config.config.get(
+        "PAGURE_TAIGA_WEBHOOK_KEY_CACHE_SIZE", 1024
+    ),
+    ttl=pagure.config.config.get("PAGURE_TAIGA_WEBHOOK_KEY_CACHE_TTL", 300),
+)
+
+# Web-process record of the signatures of the deliveries recently accepted
+_DELIVERIES = LRUCache(
+    maxsize=pagure.config.config.get("PAGURE_TAIGA_WEBHOOK_DEDUP_SIZE", 4096),
+    ttl=pagure.config.config.get("PAGURE_TAIGA_WEBHOOK_DEDUP_TTL", 3600),
+)
+
 TAIGA_NS = flask.Blueprint(
     "taiga_ns", __name__, url_prefix="/_taiga", template_folder="templates"
 )
@@ -57,48 +81,143 @@ class TaigaConfiForm(pagure.forms.PagureForm):
     )
 
 
+def _schedule(task, data, correlation_id):
+    """ Queue the given task for data received from taiga's webhook, the
+    correlation id of the event being used as the id of the task.
+
+    The task is only run after PAGURE_TAIGA_WEBHOOK_DELAY seconds, giving
+    taiga a moment to settle and reducing the chances of race conditions,
+    without holding the web worker while we wait. The tasks of a same taiga
+    ticket are run in the order they were queued.
+    """
+    _log.info(
+        "Taiga %s.%s on ref %s queued for %s, correlation_id=%s",
+        data["type"],
+        data["action"],
+        data["ref"],
+        task.name,
+        correlation_id,
+    )
+    ordering.apply_in_order(
+        task,
+        ordering.taiga_key(data),
+        (data,),
+        task_id=correlation_id,
+        countdown=pagure.config.config.get("PAGURE_TAIGA_WEBHOOK_DELAY", 1),
+    )
+
+
+def _get_webhook_key(repo, namespace, refresh=False):
+    """ Return the key taiga signs the webhooks of the specified pagure
+    project with, or an empty string if the project is not linked to taiga.
+
+    Only the keys found are cached, a project linked by another process is
+    thus noticed right away.
+    """
+    key = None if refresh else _WEBHOOK_KEYS.get((namespace, repo))
+    if key is None:
+        row = (
+            flask.g.session.query(model.PagureTaiga.taiga_token)
+            .join(
+                pagure.lib.model.Project,
+                pagure.lib.model.Project.id == model.PagureTaiga.project_id,
+            )
+            .filter(
+                pagure.lib.model.Project.name == repo,
+                pagure.lib.model.Project.namespace == namespace,
+                pagure.lib.model.Project.is_fork.is_(False),
+            )
+            .first()
+        )
+        key = (row.taiga_token if row else None) or ""
+        if key:
+            _WEBHOOK_KEYS.set((namespace, repo), key)
+        else:
+            _WEBHOOK_KEYS.pop((namespace, repo))
+    return key
+
+
+def _reject(reason, message, status):
+    """ Count and return the response rejecting a delivery of taiga's
+    webhook for the given reason.
+    """
+    _log.info("Rejecting webhook %s: %s", flask.request.path, message)
+    metrics.WEBHOOKS_REJECTED.inc(reason=reason)
+    return flask.jsonify({"error": message}), status
+
+
 @TAIGA_NS.route("/<repo>/webhook", methods=["GET", "POST"])
 @TAIGA_NS.route("/<namespace>/<repo>/webhook", methods=["GET", "POST"])
 def webhook(repo, namespace=None):
     """ Endpoint called by taiga to sync with pagure. """
-    import pprint
+    key = _get_webhook_key(repo, namespace)
+    if not key:
+        return _reject("unknown_project", "Project not linked to taiga", 404)
+
+    signature = flask.request.headers.get("X-TAIGA-WEBHOOK-SIGNATURE")
+    body = flask.request.get_data()
+    if not ingest.verify_signature(key, body, signature):
+        # The token may have been changed, by another process, since its key
+        # was cached: taiga does not deliver the rejected events again
+        fresh_key = _get_webhook_key(repo, namespace, refresh=True)
+        if fresh_key == key or not ingest.verify_signature(
+            fresh_key, body, signature
+        ):
+            return _reject("invalid_signature", "Invalid signature", 403)
+    if signature in _DELIVERIES:
+        return _reject("duplicate", "Delivery already received", 409)
+
+    try:
+        data = ingest.compact_payload(flask.request.get_json(silent=True))
+    except ingest.InvalidPayload as err:
+        return _reject("invalid_payload", str(err), 400)
+    _DELIVERIES.set(signature, True)
+    metrics.EVENTS_RECEIVED.inc(
+        source="taiga", event="%s.%s" % (data["type"], data["action"])
+    )
 
-    pprint.pprint(flask.request.json)
-    # Wait a sec before processing the request from taiga -- reduces
-    # chances of race conditions
-    time.sleep(1)
+    if data["type"] in ingest.SUPPORTED_TYPES and idempotency.is_echo(
+        idempotency.taiga_change(data)
+    ):
+        return "all good"
 
-    data = flask.request.json
     taiga_type = data["type"]
     action = data["action"]
-    if action == "create":
-        if taiga_type in ["issue", "userstory"]:
-            print("Create new ticket for corresponding %s" % taiga_type)
-            query.create_ticket_from_taiga.delay(data)
-        else:
-            print("Un-supported create action on: %s" % taiga_type)
+    correlation_id = new_correlation_id()
+    if taiga_type not in ingest.SUPPORTED_TYPES:
+        _log.debug("Un-supported action: %s on %s", action, taiga_type)
+    elif action == "create":
+        _schedule(query.create_ticket_from_taiga, data, correlation_id)
     elif action == "change":
-        if "comment" in data["change"]:
-            if data["change"]["edit_comment_date"]:
-                print("Edit comment in %s" % taiga_type)
-            elif data["change"]["delete_comment_date"]:
-                print("Deleting comment on %s" % taiga_type)
-            elif data["change"]["comment"]:
-                print("Adding a new comment on %s" % taiga_type)
-                query.comment_on_ticket_from_taiga.delay(data)
-            elif data["change"]["diff"].get("status"):
-                print("Changing status of %s" % taiga_type)
-                query.update_ticket_status_from_taiga.delay(data)
-            else:
-                print("Un-supported change on %s" % taiga_type)
+        if data["comment_edited"]:
+            _log.debug("Un-supported comment edition on %s", taiga_type)
+        elif data["comment_deleted"]:
+            _log.debug("Un-supported comment deletion on %s", taiga_type)
+        elif data["comment"]:
+            _schedule(query.comment_on_ticket_from_taiga, data, correlation_id)
+        elif data["status_to"]:
+            _schedule(
+                query.update_ticket_status_from_taiga, data, correlation_id
+            )
+        else:
+            _log.debug("Un-supported change on %s", taiga_type)
     elif action == "delete":
-        print("Deleting %s" % taiga_type)
-        query.delete_ticket_on_pagure_from_taiga.delay(data)
+        _schedule(
+            query.delete_ticket_on_pagure_from_taiga, data, correlation_id
+        )
     else:
-        print("Un-support action: %s on %s" % (action, taiga_type))
+        _log.debug("Un-supported action: %s on %s", action, taiga_type)
     return "all good"
 
 
+@TAIGA_NS.route("/metrics")
+def view_metrics():
+    """ Expose the metrics of pagure-taiga, in prometheus' format. """
+    return flask.Response(
+        metrics.render(), mimetype="text/plain; version=0.0.4"
+    )
+
+
 @TAIGA_NS.route("/<repo>/config/", methods=["GET", "POST"])
 @TAIGA_NS.route("/<repo>/config", methods=["GET", "POST"])
 @TAIGA_NS.route("/<namespace>/<repo>/config/", methods=["GET", "POST"])
@@ -139,17 +258,20 @@ def settings(repo, namespace=None):
         for webhook in taiga_project.list_webhooks():
             if webhook.name == "pagure_webhook":
                 create = False
-                webhook.url = (url,)
+                webhook.url = url
                 webhook.key = form.taiga_token.data
+                webhook.update()
                 break
 
         if create:
-            print(url, form.taiga_token.data)
+            _log.info("Adding the webhook %s to taiga", url)
             taiga_project.add_webhook(
                 name="pagure_webhook", url=url, key=form.taiga_token.data
             )
 
+        old_credentials = None
         if repo.taiga:
+            old_credentials = (repo.taiga.taiga_url, repo.taiga.taiga_token)
             repo.taiga.taiga_url = form.taiga_url.data
             repo.taiga.taiga_token = form.taiga_token.data
             repo.taiga.project_name = project_name
@@ -168,6 +290,11 @@ def settings(repo, namespace=None):
             flask.g.session.add(pagure_taiga)
         try:
             flask.g.session.commit()
+            if old_credentials:
+                client.invalidate_api(*old_credentials)
+            client.invalidate_project(taiga_project.id)
+            _WEBHOOK_KEYS.pop((repo.namespace, repo.name))
+            query.add_linked_project(repo.id)
             flask.flash("Taiga configured!")
         except SQLAlchemyError as err:  # pragma: no cover
             flask.g.session.rollback()
@@ -196,25 +323,117 @@ def settings(repo, namespace=None):
 
 pagure_signal = blinker.signal("pagure")
 
+# Key, in the info of a session, of the set of the changes synced to taiga
+# flushed to the database but not committed yet
+_FLUSHED = "pagure_taiga_flushed"
+
+
+def _get_changes(new, deleted):
+    """ Return the set of the changes synced to taiga made by adding the
+    given objects to the database and deleting the given ones.
+    """
+    changes = set()
+    for obj in new:
+        if isinstance(obj, pagure.lib.model.Issue):
+            changes.add(("issue.new", obj.project_id, obj.id))
+        elif isinstance(obj, pagure.lib.model.TagIssueColored):
+            changes.add(("issue.tag.added", obj.issue_uid))
+    for obj in deleted:
+        if isinstance(obj, pagure.lib.model.Issue):
+            changes.add(("issue.drop", obj.project_id, obj.id))
+    return changes
+
+
+@sa.event.listens_for(Session, "after_flush")
+def _mark_flushed(session, flush_context):
+    # The objects flushed are still listed as new and deleted at this point
+    session.info.setdefault(_FLUSHED, set()).update(
+        _get_changes(session.new, session.deleted)
+    )
+
+
+@sa.event.listens_for(Session, "after_commit")
+@sa.event.listens_for(Session, "after_rollback")
+def _clear_flushed(session):
+    session.info.pop(_FLUSHED, None)
+
+
+def _get_pending_session(topic, message):
+    """ Return the session of the current pagure request if the change the
+    given event notifies is part of its transaction, not committed yet, None
+    otherwise.
+
+    Pagure sends issue.new (new_issue), issue.tag.added (add_tag_obj) and
+    issue.drop (drop_issue) before the change is committed, by their caller,
+    in the same session, this is checked for each event. It commits the
+    comments before sending issue.comment.added (add_issue_comment), their
+    events are thus always stored on their own.
+    """
+    if not flask.has_app_context():
+        return None
+    session = getattr(flask.g, "session", None)
+    if session is None:
+        return None
+    changes = session.info.get(_FLUSHED, set()) | _get_changes(
+        session.new, session.deleted
+    )
+    if not changes:
+        return None
+
+    project_id = message["project"]["id"]
+    issue_id = message["issue"]["id"]
+    if topic in ("issue.new", "issue.drop"):
+        change = (topic, project_id, issue_id)
+    elif topic == "issue.tag.added":
+        # The issue tagged is loaded in the session
+        issues = [
+            obj
+            for obj in session.identity_map.values()
+            if isinstance(obj, pagure.lib.model.Issue)
+            and obj.project_id == project_id
+            and obj.id == issue_id
+        ]
+        if not issues:
+            return None
+        change = (topic, issues[0].uid)
+    else:
+        return None
+    if change in changes:
+        return session
+
 
 @pagure_signal.connect
 def receive_data(sender, topic, message, **kw):
-    print("=" * 80)
-    print("pagure-taiga received a notification")
-    import pprint
-
-    pprint.pprint(topic)
-    pprint.pprint(message)
+    dispatch = query.DISPATCH.get(topic)
+    if dispatch is None:
+        return
     try:
-        if topic == "issue.new":
-            query.new_ticket.delay(message)
-        elif topic == "issue.comment.added":
-            query.new_comment_ticket.delay(message)
-        elif topic == "issue.drop":
-            query.delete_ticket_on_taiga_from_pagure.delay(message)
-        elif topic == "issue.tag.added":
-            query.update_ticket_status_on_taiga.delay(message)
+        if message["project"]["id"] not in query.get_linked_projects():
+            return
+        metrics.EVENTS_RECEIVED.inc(source="pagure", event=topic)
+        if idempotency.is_echo(idempotency.pagure_change(topic, message)):
+            return
+        correlation_id = new_correlation_id()
+        _log.info(
+            "Pagure %s on %s#%s, correlation_id=%s",
+            topic,
+            message["project"]["fullname"],
+            message["issue"]["id"],
+            correlation_id,
+        )
+        _log.debug("Pagure %s message: %s", topic, message)
+        if pagure.config.config.get("PAGURE_TAIGA_OUTBOX", False):
+            # The event is stored along with the change it notifies when
+            # that is not committed yet, the broker is not involved in the
+            # request
+            query.add_to_outbox(
+                topic,
+                message,
+                correlation_id,
+                _get_pending_session(topic, message),
+            )
+        else:
+            dispatch(topic, message, correlation_id)
     except Exception:
         _log.exception("Could not act as desired")
-    print("=" * 80)
     return "received!"
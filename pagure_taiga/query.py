@@ -10,31 +10,81 @@
 
 from __future__ import unicode_literals, print_function
 
+import calendar
+import datetime
+import functools
+import json
 import logging
-import os
+import random
+import threading
+import time
 
+import redis
+import sqlalchemy as sa
 from celery import Celery
 from celery.signals import after_setup_task_logger
-from taiga import TaigaAPI
+from celery.utils.time import maybe_iso8601
 import taiga.exceptions
+from kombu.exceptions import OperationalError
+from sqlalchemy.orm import make_transient_to_detached
 
 from pagure.lib.tasks_utils import pagure_task
 from pagure.config import config as pagure_config
 import pagure.lib.query
 import pagure.lib.model
+import pagure.lib.model_base
 
+from pagure_taiga import client
+from pagure_taiga import idempotency
+from pagure_taiga import ingest
+from pagure_taiga import metrics
 from pagure_taiga import model
+from pagure_taiga import ordering
+from pagure_taiga.cache import LRUCache
+from pagure_taiga.utils import (
+    CorrelationIdFilter,
+    get_broker_url,
+    get_redis,
+    hash_comment,
+)
 
 _log = logging.getLogger(__name__)
 
 
-if os.environ.get("PAGURE_BROKER_URL"):
-    broker_url = os.environ["PAGURE_BROKER_URL"]
-elif pagure_config.get("BROKER_URL"):
-    broker_url = pagure_config["BROKER_URL"]
-else:
-    broker_url = "redis://%s" % pagure_config["REDIS_HOST"]
+# Redis keys used to coalesce the events received for a ticket
+EVENTS_KEY = "pagure_taiga:events:%s"
+PENDING_KEY = "pagure_taiga:pending:%s"
+COALESCED_TOPICS = ("issue.comment.added", "issue.tag.added")
+
+# Redis keys used to batch the status changes of the user stories of a taiga
+# project
+STATUSES_KEY = "pagure_taiga:statuses:%s"
+STATUSES_PENDING_KEY = "pagure_taiga:statuses_pending:%s"
+
+# Redis key preventing a project from being reconciled twice at once
+RECONCILE_LOCK_KEY = "pagure_taiga:reconcile:%s"
+# Redis key preventing the outbox from being relayed twice at once
+OUTBOX_LOCK_KEY = "pagure_taiga:outbox"
+
+# Worker-local cache of the mappings, in both lookup directions
+_MAPPINGS = LRUCache(
+    maxsize=pagure_config.get("PAGURE_TAIGA_MAPPING_CACHE_SIZE", 4096),
+    ttl=pagure_config.get("PAGURE_TAIGA_MAPPING_CACHE_TTL", 300),
+)
+
+# Worker-local cache of the tags known to exist, per pagure project
+_TAGS = LRUCache(
+    maxsize=pagure_config.get("PAGURE_TAIGA_PROJECT_CACHE_SIZE", 256),
+    ttl=pagure_config.get("PAGURE_TAIGA_PROJECT_CACHE_TTL", 600),
+)
+
+# Process-local set of the identifiers of the pagure projects linked to
+# taiga, as (set, time it was loaded)
+_LINKED_PROJECTS = [frozenset(), None]
+_LINKED_PROJECTS_LOCK = threading.Lock()
+_SESSION = None
 
+broker_url = get_broker_url()
 conn = Celery("tasks", broker=broker_url, backend=broker_url)
 conn.conf.update(pagure_config["CELERY_CONFIG"])
 
@@ -42,6 +92,64 @@ conn.conf.update(pagure_config["CELERY_CONFIG"])
 @after_setup_task_logger.connect
 def augment_celery_log(**kwargs):
     pagure.utils.set_up_logging(force=True)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(CorrelationIdFilter())
+
+
+def _mapping_keys(values):
+    """ Return the keys under which the mapping with the given values is
+    cached, one for each lookup direction.
+    """
+    return (
+        (
+            "pagure",
+            values["taiga_project"],
+            values["pagure_ticket_id"],
+            values["taiga_type"],
+        ),
+        (
+            "taiga",
+            values["taiga_project"],
+            values["taiga_id"],
+            values["taiga_type"],
+        ),
+    )
+
+
+def _get_mapping_values(mapping):
+    """ Return the values of the columns of the given mapping. """
+    return dict(
+        (column.name, getattr(mapping, column.name))
+        for column in model.PagureTaigaMapping.__table__.columns
+    )
+
+
+def _get_cached_mapping(session, key, query):
+    """ Return the mapping cached under the given key, attached to the
+    given session without querying the database, or run the given query
+    and cache its result.
+    """
+    values = _MAPPINGS.get(key)
+    if values is not None:
+        mapping = model.PagureTaigaMapping(**values)
+        make_transient_to_detached(mapping)
+        return session.merge(mapping, load=False)
+
+    mapping = query.first()
+    if mapping:
+        values = _get_mapping_values(mapping)
+        for mapping_key in _mapping_keys(values):
+            _MAPPINGS.set(mapping_key, values)
+    return mapping
+
+
+@sa.event.listens_for(model.PagureTaigaMapping, "after_insert")
+@sa.event.listens_for(model.PagureTaigaMapping, "after_update")
+@sa.event.listens_for(model.PagureTaigaMapping, "after_delete")
+def _invalidate_mapping(mapper, connection, mapping):
+    """ Drop the given mapping from the cache when it changes. """
+    for mapping_key in _mapping_keys(_get_mapping_values(mapping)):
+        _MAPPINGS.pop(mapping_key)
 
 
 def get_ticket_mapping_from_pagure(
@@ -55,7 +163,9 @@ def get_ticket_mapping_from_pagure(
         model.PagureTaigaMapping.pagure_ticket_id == pagure_id,
         model.PagureTaigaMapping.taiga_type == taiga_type,
     )
-    return query.first()
+    return _get_cached_mapping(
+        session, ("pagure", taiga_project_id, pagure_id, taiga_type), query
+    )
 
 
 def get_ticket_mapping_from_taiga(
@@ -69,7 +179,56 @@ def get_ticket_mapping_from_taiga(
         model.PagureTaigaMapping.taiga_id == taiga_id,
         model.PagureTaigaMapping.taiga_type == taiga_type,
     )
-    return query.first()
+    return _get_cached_mapping(
+        session, ("taiga", taiga_project_id, taiga_id, taiga_type), query
+    )
+
+
+def find_mapping_from_pagure(
+    session, taiga_config, taiga_project_id, pagure_id
+):
+    """ Return the mapping of the specified ticket of the pagure project
+    linked to the given PagureTaiga object.
+
+    The tickets of kanban projects used to be synced with issues rather
+    than user stories, the tickets linked then are still found.
+    """
+    taiga_type = get_taiga_type(taiga_config)
+    mapping = get_ticket_mapping_from_pagure(
+        session, taiga_project_id, pagure_id, taiga_type
+    )
+    if not mapping and taiga_type == "userstory":
+        mapping = get_ticket_mapping_from_pagure(
+            session, taiga_project_id, pagure_id, "issue"
+        )
+    return mapping
+
+
+def _ticket_lookup(mapping):
+    """ Return the arguments of client.get_ticket_data looking up the taiga
+    ticket of the given mapping.
+    """
+    if mapping.taiga_object_id is not None:
+        return {"object_id": mapping.taiga_object_id}
+    # Mapping created before the identifier of the tickets was stored
+    return {"taiga_project_id": mapping.taiga_project, "ref": mapping.taiga_id}
+
+
+def get_mapped_ticket(api, mapping):
+    """ Return the taiga issue or user story of the given mapping. """
+    return client.get_ticket(
+        api, mapping.taiga_type, **_ticket_lookup(mapping)
+    )
+
+
+def store_taiga_object_id(session, mapping, object_id, commit=True):
+    """ Store the given identifier of the taiga ticket of the given mapping
+    if the mapping was created before these were stored.
+    """
+    if mapping.taiga_object_id is None and object_id is not None:
+        mapping.taiga_object_id = object_id
+        if commit:
+            session.commit()
 
 
 def get_pagure_project_from_taiga(session, taiga_project_id):
@@ -85,305 +244,297 @@ def get_pagure_project_from_taiga(session, taiga_project_id):
         return mapping.project
 
 
-def get_comment_of_ticket(session, ticket, comment_text):
-    """ Return the IssueComment of the specified ticket having the given
-    text.
+def _get_session():
+    """ Return the session pagure-taiga uses outside of pagure's requests
+    and tasks.
     """
-    query = session.query(pagure.lib.model.IssueComment).filter(
-        pagure.lib.model.IssueComment.issue_uid == ticket.uid,
-        pagure.lib.model.IssueComment.comment == comment_text,
-    )
-    return query.first()
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = pagure.lib.model_base.create_session(
+            pagure_config["DB_URL"]
+        )
+    return _SESSION
 
 
-def _get_issue(session, project, taiga_data):
-    """ Return the issue corresponding to the data retrieved from taiga
-    based on the mapping stored in the database.
+def get_linked_projects():
+    """ Return the set of the identifiers of the pagure projects linked to
+    taiga, reloaded from the database every PAGURE_TAIGA_LINKED_PROJECTS_TTL
+    seconds.
     """
-    taiga_project_id = taiga_data["data"]["project"]["id"]
-
-    # Ensure the issue already exists
-    _log.info("Checking if the ticket exists in the pagure's project")
-    mapping = get_ticket_mapping_from_taiga(
-        session,
-        taiga_project_id,
-        taiga_data["data"]["ref"],
-        taiga_data["type"],
-    )
-    if not mapping:
-        _log.info("Ticket not found in the database, creating it")
-        create_ticket_from_taiga(session, taiga_data)
-        mapping = get_ticket_mapping_from_taiga(
-            session,
-            taiga_project_id,
-            taiga_data["data"]["ref"],
-            taiga_data["type"],
-        )
-        if not mapping:
-            _log.info("Ticket still not found in the database, bailing")
-            return
+    linked, stamp = _LINKED_PROJECTS
+    ttl = pagure_config.get("PAGURE_TAIGA_LINKED_PROJECTS_TTL", 60)
+    if stamp is not None and time.time() - stamp < ttl:
+        return linked
+
+    with _LINKED_PROJECTS_LOCK:
+        if _LINKED_PROJECTS[1] != stamp:
+            # Reloaded by another thread in the meantime
+            return _LINKED_PROJECTS[0]
+        session = _get_session()
+        try:
+            linked = frozenset(
+                row.project_id
+                for row in session.query(model.PagureTaiga.project_id)
+            )
+        finally:
+            session.remove()
+        _LINKED_PROJECTS[:] = [linked, time.time()]
+    return linked
+
+
+def add_linked_project(project_id):
+    """ Add the specified pagure project to the set of the projects linked
+    to taiga of this process.
+    """
+    with _LINKED_PROJECTS_LOCK:
+        _LINKED_PROJECTS[0] = _LINKED_PROJECTS[0] | frozenset([project_id])
 
-    # Issue found
-    _log.info(
-        "Issue (taiga ref %s) found in our mapping" % taiga_data["data"]["ref"]
-    )
 
-    issue = pagure.lib.query.search_issues(
-        session, project, issueid=mapping.pagure_ticket_id
+def get_synced_comment(session, mapping, comment_hash):
+    """ Return the PagureTaigaComment recording that a comment with the
+    given hash was synced for the specified mapping.
+    """
+    query = session.query(model.PagureTaigaComment).filter(
+        model.PagureTaigaComment.mapping_id == mapping.id,
+        model.PagureTaigaComment.comment_hash == comment_hash,
     )
-    if issue:
-        _log.info(
-            "Issue (taiga ref %s) found in pagure: %s"
-            % (taiga_data["data"]["ref"], issue)
-        )
-        return issue
+    return query.first()
 
 
-@conn.task(
-    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
-)
-@pagure_task
-def new_ticket(self, session, data):
-    """ Create a new ticket on taiga. """
-    reponame = data["project"]["name"]
-    username = (
-        data["project"]["user"]["name"] if data["project"]["parent"] else None
+def get_taiga_comments(api, taiga_type, object_id):
+    """ Return the text of the comments, not deleted, found in the history
+    of the specified taiga issue or user story.
+    """
+    if taiga_type == "userstory":
+        history = api.history.user_story.get(object_id)
+    else:
+        history = api.history.issue.get(object_id)
+    return [
+        entry["comment"]
+        for entry in history
+        if entry["comment"] and not entry["delete_comment_date"]
+    ]
+
+
+def record_history_comments(session, api, mapping, issue, object_id):
+    """ Record as synced the comments of the given pagure issue found in the
+    history of its taiga ticket, completing the comments recorded for a
+    mapping created before they were.
+    """
+    found = set(
+        hash_comment(text)
+        for text in get_taiga_comments(api, mapping.taiga_type, object_id)
     )
-    namespace = data["project"]["namespace"]
-    project = pagure.lib.query.get_authorized_project(
-        session, reponame, user=username, namespace=namespace
+    recorded = set(
+        row.pagure_comment_id
+        for row in session.query(
+            model.PagureTaigaComment.pagure_comment_id
+        ).filter(model.PagureTaigaComment.mapping_id == mapping.id)
     )
+    for comment in issue.comments:
+        comment_hash = hash_comment(comment.comment)
+        if comment.id not in recorded and comment_hash in found:
+            session.add(
+                model.PagureTaigaComment(
+                    mapping_id=mapping.id,
+                    pagure_comment_id=comment.id,
+                    comment_hash=comment_hash,
+                )
+            )
+    mapping.comments_recorded = True
+    session.commit()
 
-    api = TaigaAPI(
-        token=project.taiga.taiga_token, host=project.taiga.taiga_url
-    )
-    if project.taiga.project_type == "kanboard":
-        taiga_type = "userstory"
-    else:
-        taiga_type = "issue"
 
-    taiga_project = api.projects.get_by_slug(project.taiga.project_name)
-    if get_ticket_mapping_from_pagure(
-        session,
-        taiga_project_id=taiga_project.id,
-        pagure_id=data["issue"]["id"],
-        taiga_type=taiga_type,
-    ):
-        _log.info("Ticket already exists in taiga, bailing")
-        return
+def get_comment_of_ticket(session, ticket, comment_text):
+    """ Return the IssueComment of the specified ticket having the given
+    text.
 
-    if project.taiga.project_type == "kanboard":
-        _log.info("Project is kanboard - adding userstory")
-        taiga_user_story = taiga_project.add_user_story(
-            subject=data["issue"]["title"],
-            description=data["issue"]["content"],
-        )
-        _log.info(
-            "Adding mapping: %s to %s for project: %s",
-            taiga_user_story.ref,
-            data["issue"]["id"],
-            taiga_project.id,
-        )
-        mapping = model.PagureTaigaMapping(
-            taiga_project=taiga_project.id,
-            taiga_id=taiga_user_story.ref,
-            pagure_ticket_id=data["issue"]["id"],
-            taiga_type="userstory",
-        )
-        session.add(mapping)
-        session.commit()
-    else:
-        taiga_issue = taiga_project.add_issue(
-            subject=data["issue"]["title"],
-            priority=data["issue"]["priority"],
-            status=taiga_project.issue_statuses.get(
-                name=data["issue"]["status"]
-            ),
-            issue_type=None,
-            severity=None,
-            description=data["issue"]["content"],
-        )
-        _log.info(
-            "Adding mapping: %s to %s for project: %s",
-            taiga_issue.ref,
-            data["issue"]["id"],
-            taiga_project.id,
+    Comments are looked up via the digest stored for them in the
+    pagure_taiga_comment_digest table.
+    """
+    query = (
+        session.query(pagure.lib.model.IssueComment)
+        .join(
+            model.PagureTaigaCommentDigest,
+            model.PagureTaigaCommentDigest.comment_id
+            == pagure.lib.model.IssueComment.id,
         )
-        mapping = model.PagureTaigaMapping(
-            taiga_project=taiga_project.id,
-            taiga_id=taiga_issue.ref,
-            pagure_ticket_id=data["issue"]["id"],
-            taiga_type="issue",
+        .filter(
+            model.PagureTaigaCommentDigest.issue_uid == ticket.uid,
+            model.PagureTaigaCommentDigest.digest
+            == hash_comment(comment_text),
         )
-        session.add(mapping)
-        session.commit()
-    _log.info("Ticket created in taiga from pagure")
+    )
+    return query.first()
 
 
-@conn.task(
-    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
-)
-@pagure_task
-def new_comment_ticket(self, session, data):
-    """ Add a new comment on a ticket in taiga. """
-    reponame = data["project"]["name"]
-    username = (
-        data["project"]["user"]["name"] if data["project"]["parent"] else None
+def add_comment_digest(session, comment):
+    """ Store the digest of the specified IssueComment, unless it is
+    already stored (for example by createdb.py --backfill-digests).
+    """
+    query = session.query(model.PagureTaigaCommentDigest.id).filter(
+        model.PagureTaigaCommentDigest.comment_id == comment.id
     )
-    namespace = data["project"]["namespace"]
-    project = pagure.lib.query.get_authorized_project(
-        session, reponame, user=username, namespace=namespace
+    if query.first() is not None:
+        return
+    session.add(
+        model.PagureTaigaCommentDigest(
+            issue_uid=comment.issue_uid,
+            comment_id=comment.id,
+            digest=hash_comment(comment.comment),
+        )
     )
 
-    api = TaigaAPI(
-        token=project.taiga.taiga_token, host=project.taiga.taiga_url
-    )
 
-    taiga_project = api.projects.get_by_slug(project.taiga.project_name)
+def get_taiga_type(taiga_config):
+    """ Return the type of object (userstory or issue) the tickets of the
+    pagure project linked to the specified PagureTaiga object are synced
+    with in taiga.
+    """
+    if taiga_config.project_type == "kanban":
+        return "userstory"
+    return "issue"
 
-    if project.taiga.project_type == "kanboard":
-        issue_type = "userstory"
-    else:
-        issue_type = "issue"
 
-    mapping = get_ticket_mapping_from_pagure(
-        session=session,
-        taiga_project_id=taiga_project.id,
-        pagure_id=data["issue"]["id"],
-        taiga_type=issue_type,
+def create_taiga_ticket(
+    taiga_project, taiga_type, title, content, priority=None, status=None
+):
+    """ Create a user story or an issue (depending on the specified type)
+    in the specified taiga project and return it.
+    """
+    idempotency.record(
+        "taiga", taiga_type, taiga_project.id, "create", hash_comment(title)
+    )
+    if taiga_type == "userstory":
+        return taiga_project.add_user_story(
+            subject=title, description=content
+        )
+    return taiga_project.add_issue(
+        subject=title,
+        priority=priority,
+        status=taiga_project.issue_statuses.get(name=status),
+        issue_type=None,
+        severity=None,
+        description=content,
     )
-    if not mapping:
-        print("No corresponding issue found in our mapping")
-        return
-
-    issue = taiga_project.get_userstory_by_ref(mapping.taiga_id)
 
-    if issue:
-        _log.info("Found issue, searching comment")
-        found = False
-        if issue_type == "userstory":
-            history = api.history.user_story.get(issue.id)
-        else:
-            history = api.history.issue.get(issue.id)
-        new_comment = data["issue"]["comments"][-1]
-        for comment in history:
-            if comment["delete_comment_date"]:
-                # Ignore deleted comments
-                continue
-            # if comment["user"]["name"] != new_comment["user"]["name"]:
-            # Ignore comment made by someone else
-            # continue
-            if comment["comment"] == new_comment["comment"]:
-                # Comment already posted
-                found = True
-
-        if not found:
-            issue.add_comment(data["issue"]["comments"][-1]["comment"])
 
+def resolve_taiga_ticket(session, taiga_data):
+    """ Return the pagure project, the mapping and the pagure ticket
+    corresponding to the data retrieved from taiga, using a single query.
 
-@conn.task(
-    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
-)
-@pagure_task
-def delete_ticket_on_taiga_from_pagure(self, session, data):
-    """ Delete the ticket in taiga based on the information provided by
-    pagure.
+    The mapping and the ticket are None if the ticket is not known to
+    pagure yet and all three are None if the taiga project is not linked to
+    any pagure project.
     """
-    reponame = data["project"]["name"]
-    username = (
-        data["project"]["user"]["name"] if data["project"]["parent"] else None
-    )
-    namespace = data["project"]["namespace"]
-    project = pagure.lib.query.get_authorized_project(
-        session, reponame, user=username, namespace=namespace
+    project_id = taiga_data["project_id"]
+    query = (
+        session.query(
+            pagure.lib.model.Project,
+            model.PagureTaigaMapping,
+            pagure.lib.model.Issue,
+        )
+        .select_from(model.PagureTaiga)
+        .join(
+            pagure.lib.model.Project,
+            pagure.lib.model.Project.id == model.PagureTaiga.project_id,
+        )
+        .outerjoin(
+            model.PagureTaigaMapping,
+            sa.and_(
+                model.PagureTaigaMapping.taiga_project
+                == model.PagureTaiga.taiga_project_id,
+                model.PagureTaigaMapping.taiga_id == taiga_data["ref"],
+                model.PagureTaigaMapping.taiga_type == taiga_data["type"],
+            ),
+        )
+        .outerjoin(
+            pagure.lib.model.Issue,
+            sa.and_(
+                pagure.lib.model.Issue.project_id
+                == pagure.lib.model.Project.id,
+                pagure.lib.model.Issue.id
+                == model.PagureTaigaMapping.pagure_ticket_id,
+            ),
+        )
+        .filter(model.PagureTaiga.taiga_project_id == project_id)
     )
+    row = query.first()
+    if not row:
+        return None, None, None
+    return row
 
-    api = TaigaAPI(
-        token=project.taiga.taiga_token, host=project.taiga.taiga_url
-    )
 
-    taiga_project = api.projects.get_by_slug(project.taiga.project_name)
+def _get_issue(session, taiga_data):
+    """ Return the pagure project, the mapping and the issue corresponding
+    to the data retrieved from taiga, creating the issue in pagure if it
+    does not exist there yet.
 
-    if project.taiga.project_type == "kanboard":
-        issue_type = "userstory"
-    else:
-        issue_type = "issue"
+    Only meant for the creations, comments and status changes of taiga, the
+    other events on a ticket not mapped are to be ignored.
+    """
+    project, mapping, issue = resolve_taiga_ticket(session, taiga_data)
+    if not project:
+        _log.info("No pagure project found associated, bailing")
+        return None, None, None
 
-    mapping = get_ticket_mapping_from_pagure(
-        session=session,
-        taiga_project_id=taiga_project.id,
-        pagure_id=data["issue"]["id"],
-        taiga_type=issue_type,
-    )
     if not mapping:
-        print("No corresponding issue found in our mapping")
-        return
+        _log.info("Ticket not found in the database, creating it")
+        _create_ticket_from_taiga(session, project, taiga_data)
+        project, mapping, issue = resolve_taiga_ticket(session, taiga_data)
+        if not mapping:
+            _log.info("Ticket still not found in the database, bailing")
+            return project, None, None
 
-    try:
-        issue = taiga_project.get_userstory_by_ref(mapping.taiga_id)
-        issue.delete()
-        session.delete(mapping)
-        session.commit()
-    except taiga.exceptions.TaigaRestException:
-        _log.exception("Could find/delete the ticket")
+    # Issue found
+    _log.info("Issue (taiga ref %s) found in our mapping", taiga_data["ref"])
+    # Committed along with the change made by the caller
+    store_taiga_object_id(session, mapping, taiga_data["id"], commit=False)
+    if issue:
+        _log.info(
+            "Issue (taiga ref %s) found in pagure: %s",
+            taiga_data["ref"],
+            issue,
+        )
+    return project, mapping, issue
 
 
-@conn.task(
-    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
-)
-@pagure_task
-def create_ticket_from_taiga(self, session, taiga_data):
-    """ Creates a ticket in pagure based on the information provided by
-    taiga's webhook.
+def _create_ticket_from_taiga(session, project, taiga_data):
+    """ Create in the given pagure project the ticket corresponding to the
+    data retrieved from taiga.
     """
-
-    taiga_project_id = taiga_data["data"]["project"]["id"]
-    project = get_pagure_project_from_taiga(session, taiga_project_id)
-    if not project:
-        _log.info("No pagure project found associated, bailing")
-        return
+    taiga_project_id = taiga_data["project_id"]
 
     # username = taiga_data["by"]["username"]
     username = "pingou"
-    assignee = taiga_data["data"]["assigned_to"]
-    milestone = taiga_data["data"]["milestone"]
+    assignee = taiga_data["assigned_to"]
+    milestone = taiga_data["milestone"]
     priority = None
-    tags = [taiga_data["data"]["status"]["name"]] + taiga_data["data"]["tags"]
-
-    # Check if tag/status exist in the project, if not add them
-    _log.info("Checking if tags and status exist in the pagure's project")
-
-    # Check if issue already exists
-    _log.info("Checking if the ticket exists in the pagure's project")
-    if get_ticket_mapping_from_taiga(
-        session,
-        taiga_project_id,
-        taiga_data["data"]["ref"],
-        taiga_data["type"],
-    ):
-        _log.info("Ticket already in the database, bailing")
-        return
+    tags = [taiga_data["status"]] + taiga_data["tags"]
 
     # Issue not found, adding it
     _log.info(
-        "Issue (taiga ref %s) not found, adding it to pagure"
-        % taiga_data["data"]["ref"]
+        "Issue (taiga ref %s) not found, adding it to pagure",
+        taiga_data["ref"],
     )
     issue_id = pagure.lib.query.get_next_id(session, project.id)
     mapping = model.PagureTaigaMapping(
         taiga_project=taiga_project_id,
-        taiga_id=taiga_data["data"]["ref"],
+        taiga_id=taiga_data["ref"],
         pagure_ticket_id=issue_id,
         taiga_type=taiga_data["type"],
+        taiga_object_id=taiga_data["id"],
+        comments_recorded=True,
     )
     session.add(mapping)
     session.commit()
+    idempotency.record("pagure", project.id, issue_id, "new")
     pagure.lib.query.new_issue(
         session,
         repo=project,
         issue_id=issue_id,
-        title=taiga_data["data"]["subject"],
-        content=taiga_data["data"]["description"],
+        title=taiga_data["subject"],
+        content=taiga_data["description"],
         private=False,
         user=username,
         assignee=assignee,
@@ -394,199 +545,1288 @@ def create_ticket_from_taiga(self, session, taiga_data):
     session.commit()
 
 
-@conn.task(
-    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
-)
-@pagure_task
-def comment_on_ticket_from_taiga(self, session, taiga_data):
-    """ Comment on a ticket in pagure based on the information provided by
-    taiga's webhook.
-    """
-    taiga_project_id = taiga_data["data"]["project"]["id"]
-    project = get_pagure_project_from_taiga(session, taiga_project_id)
-    if not project:
-        _log.info("No pagure project found associated, bailing")
-        return
-
-    # username = taiga_data["by"]["username"]
-    username = "pingou"
-    assignee = taiga_data["data"]["assigned_to"]
-    milestone = taiga_data["data"]["milestone"]
-    priority = None
-    tags = [taiga_data["data"]["status"]["name"]] + taiga_data["data"]["tags"]
-
-    # Check if tag/status exist in the project, if not add them
-    _log.info("Checking if tags and status exist in the pagure's project")
-
-    issue = _get_issue(session, project, taiga_data)
-    if not issue:
-        _log.info("No corresponding issue found")
-        return
-
-    if not get_comment_of_ticket(
-        session, issue, taiga_data["change"]["comment"]
-    ):
-        pagure.lib.query.add_issue_comment(
-            session,
-            issue=issue,
-            comment=taiga_data["change"]["comment"],
-            # user=taiga_data["by"]["username"],
-            user="pingou",
-        )
-    else:
-        _log.info("Comment already existing on the ticket, bailing")
-
+def ensure_tag(session, project, tag, color):
+    """ Make sure the given tag exists in the specified pagure project,
+    creating it (without committing) if it does not.
 
-@conn.task(
-    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
-)
-@pagure_task
-def update_ticket_status_from_taiga(self, session, taiga_data):
-    """ Update the status of a ticket in pagure based on the information
-    provided by taiga's webhook.
+    The tags known to exist are cached per project so most calls do not
+    query the database.
     """
-    taiga_project_id = taiga_data["data"]["project"]["id"]
-    project = get_pagure_project_from_taiga(session, taiga_project_id)
-    if not project:
-        _log.info("No pagure project found associated, bailing")
-        return
-
-    issue = _get_issue(session, project, taiga_data)
-    if not issue:
-        _log.info("No corresponding issue found")
+    known = _TAGS.get(project.id)
+    if known is not None and tag in known:
         return
-
-    new_tag = taiga_data["change"]["diff"]["status"]["to"]
-    old_tag = taiga_data["change"]["diff"]["status"]["from"]
-
-    issue_tags_text = [t.tag for t in project.tags_colored]
-    if new_tag not in issue_tags_text:
+    if pagure.lib.query.get_colored_tag(session, tag, project.id):
+        if known is None:
+            known = set()
+            _TAGS.set(project.id, known)
+        known.add(tag)
+    else:
         pagure.lib.query.new_tag(
             session=session,
-            tag_name=taiga_data["data"]["status"]["name"],
-            tag_description=taiga_data["data"]["status"]["name"],
-            tag_color=taiga_data["data"]["status"]["color"],
+            tag_name=tag,
+            tag_description=tag,
+            tag_color=color,
             project_id=project.id,
         )
-        session.commit()
 
-    tags = issue.tags_text
-    if old_tag in tags:
-        tags.remove(old_tag)
-    tags.append(new_tag)
 
+def _update_statuses_from_taiga(session, project, changes):
+    """ Replace, on each of the given pagure issues, the tag of the old taiga
+    status by the one of the new status, as provided by taiga for it. The
+    changes are given as a list of (issue, taiga_data) tuples.
+
+    Nothing is committed: the tags and the notification of the update are
+    added via the calls pagure's update_tags and add_metadata_update_notif
+    rely on, these two committing on their own.
+    """
     # username = taiga_data["by"]["username"]
     username = "pingou"
+    user = pagure.lib.query.get_user(session, username)
+    now = datetime.datetime.utcnow()
+
+    for issue, taiga_data in changes:
+        new_tag = taiga_data["status_to"]
+        old_tag = taiga_data["status_from"]
+        client.check_status(
+            taiga_data["project_id"], taiga_data["type"], new_tag
+        )
 
-    messages = set(
-        pagure.lib.query.update_tags(
-            session=session, obj=issue, tags=tags, username=username
+        ensure_tag(session, project, new_tag, taiga_data["status_color"])
+
+        tags = issue.tags_text
+        messages = []
+        if old_tag in tags and old_tag != new_tag:
+            messages.append(
+                pagure.lib.query.remove_tags_obj(
+                    session, obj=issue, tags=[old_tag], user=username
+                )
+            )
+        if new_tag not in tags:
+            idempotency.record("pagure", project.id, issue.id, "tags", new_tag)
+            messages.append(
+                pagure.lib.query.add_tag_obj(
+                    session, obj=issue, tags=[new_tag], user=username
+                )
+            )
+        if not messages:
+            continue
+
+        session.add(
+            pagure.lib.model.IssueComment(
+                issue_uid=issue.uid,
+                comment="**Metadata Update from @%s**:\n- %s"
+                % (username, "\n- ".join(sorted(messages))),
+                user_id=user.id,
+                notification=True,
+            )
         )
-    )
-    not_needed = set(["Comment added", "Updated comment"])
-    pagure.lib.query.add_metadata_update_notif(
-        session=session,
-        obj=issue,
-        messages=messages - not_needed,
-        user=username,
-    )
-    session.commit()
+        issue.last_updated = now
+        session.add(issue)
 
 
-@conn.task(
-    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
-)
-@pagure_task
-def update_ticket_status_on_taiga(self, session, data):
-    """ Update the status of a ticket in taiga based on the information
-    provided by pagure.
-    """
+def _get_project_from_pagure(session, data):
+    """ Return the pagure project concerned by the data sent by pagure. """
     reponame = data["project"]["name"]
     username = (
         data["project"]["user"]["name"] if data["project"]["parent"] else None
     )
     namespace = data["project"]["namespace"]
-    project = pagure.lib.query.get_authorized_project(
+    return pagure.lib.query.get_authorized_project(
         session, reponame, user=username, namespace=namespace
     )
 
-    issue_tags = data["tags"]
 
-    api = TaigaAPI(
-        token=project.taiga.taiga_token, host=project.taiga.taiga_url
+def _get_unsynced_comments(session, mapping, comments):
+    """ Return the given pagure comments which were not already synced with
+    the taiga ticket of the specified mapping, with their hash.
+    """
+    to_sync = []
+    hashes = set()
+    for comment in comments:
+        comment_hash = hash_comment(comment["comment"])
+        if comment_hash in hashes or get_synced_comment(
+            session, mapping, comment_hash
+        ):
+            _log.info("Comment already synced with taiga, skipping")
+            continue
+        hashes.add(comment_hash)
+        to_sync.append((comment, comment_hash))
+    return to_sync
+
+
+def _post_comments_on_taiga(
+    session, api, taiga_type, mapping, issue, comments
+):
+    """ Post the given pagure comments, as returned by
+    _get_unsynced_comments, on the given taiga ticket.
+    """
+    posted = set()
+    # Tickets whose comments were synced before we started recording
+    # them: fall back to searching the comments in the ticket's history
+    if not mapping.comments_recorded:
+        _log.info("Found issue, searching comment")
+        posted.update(get_taiga_comments(api, taiga_type, issue.id))
+
+    for comment, comment_hash in comments:
+        if comment["comment"] not in posted:
+            idempotency.record(
+                "taiga",
+                mapping.taiga_type,
+                mapping.taiga_project,
+                mapping.taiga_id,
+                "comment",
+                comment_hash,
+            )
+            issue.add_comment(comment["comment"])
+        session.add(
+            model.PagureTaigaComment(
+                mapping_id=mapping.id,
+                pagure_comment_id=comment["id"],
+                comment_hash=comment_hash,
+            )
+        )
+        comment_obj = session.query(pagure.lib.model.IssueComment).get(
+            comment["id"]
+        )
+        if comment_obj:
+            add_comment_digest(session, comment_obj)
+        # Recorded right away: if a later comment fails, the task is retried
+        # and must not post this one again
+        session.commit()
+
+
+def _add_comment_from_taiga(session, project, mapping, issue, text):
+    """ Add the given comment, made in taiga, on the given pagure issue
+    unless it is already there and return whether it was added.
+    """
+    if get_comment_of_ticket(session, issue, text):
+        return False
+
+    idempotency.record(
+        "pagure", project.id, issue.id, "comment", hash_comment(text)
+    )
+    pagure.lib.query.add_issue_comment(
+        session,
+        issue=issue,
+        comment=text,
+        # user=taiga_data["by"]["username"],
+        user="pingou",
     )
+    # Record the comment as synced so it is not sent back to taiga
+    comment = issue.comments[-1]
+    session.add(
+        model.PagureTaigaComment(
+            mapping_id=mapping.id,
+            pagure_comment_id=comment.id,
+            comment_hash=hash_comment(text),
+        )
+    )
+    add_comment_digest(session, comment)
+    return True
+
+
+def _resolve_status(statuses, tags):
+    """ Return the name and identifier of the status, among the given
+    status index, corresponding to the given tags or None if no tag
+    matches a status. If several tags match a status, the one furthest in
+    the workflow is returned.
+    """
+    matching = [(statuses[tag], tag) for tag in tags if tag in statuses]
+    if matching:
+        (_, status_id), status_name = max(matching)
+        return status_name, status_id
 
-    taiga_project = api.projects.get_by_slug(project.taiga.project_name)
 
-    if project.taiga.project_type == "kanboard":
-        issue_type = "userstory"
-        statuses = taiga_project.list_user_story_statuses()
+def _update_status_on_taiga(mapping, issue, status_name, status_id):
+    """ Update the status of the given taiga ticket, of the given mapping.
+    """
+    _log.info("Updating the status to %s (id:%s)", status_name, status_id)
+    idempotency.record(
+        "taiga",
+        mapping.taiga_type,
+        mapping.taiga_project,
+        mapping.taiga_id,
+        "status",
+        status_name,
+    )
+    issue.status = status_id
+    issue.update()
+
+
+def _ticket_key(message):
+    """ Return the key identifying the ticket concerned by the given
+    message sent by pagure.
+    """
+    return "%s:%s" % (message["project"]["id"], message["issue"]["id"])
+
+
+def queue_ticket_event(topic, message, correlation_id=None):
+    """ Queue the given event so that all the events received for the
+    same ticket within PAGURE_TAIGA_COALESCE_WINDOW seconds are synced to
+    taiga by a single sync_ticket task.
+    """
+    window = pagure_config.get("PAGURE_TAIGA_COALESCE_WINDOW", 5)
+    if not window:
+        if topic == "issue.comment.added":
+            task = new_comment_ticket
+        else:
+            task = update_ticket_status_on_taiga
+        ordering.apply_in_order(
+            task,
+            ordering.pagure_key(message),
+            (message,),
+            task_id=correlation_id,
+        )
+        return
+
+    ticket_key = _ticket_key(message)
+    pipe = get_redis().pipeline()
+    pipe.rpush(
+        EVENTS_KEY % ticket_key,
+        json.dumps(
+            {
+                "topic": topic,
+                "message": message,
+                "correlation_id": correlation_id,
+            }
+        ),
+    )
+    pipe.set(PENDING_KEY % ticket_key, 1, nx=True, ex=window * 10 + 60)
+    _, first = pipe.execute()
+    if first:
+        ordering.apply_in_order(
+            sync_ticket,
+            ordering.pagure_key(message),
+            (ticket_key,),
+            countdown=window,
+        )
     else:
-        issue_type = "issue"
-        statuses = taiga_project.list_issue_statuses()
-    statuses_text = [i.name for i in statuses]
+        _log.debug("Sync of ticket %s already scheduled", ticket_key)
 
-    mapping = get_ticket_mapping_from_pagure(
-        session=session,
-        taiga_project_id=taiga_project.id,
-        pagure_id=data["issue"]["id"],
-        taiga_type=issue_type,
+
+def add_to_outbox(topic, message, correlation_id, session=None):
+    """ Store the given event in the outbox, to be relayed to celery by the
+    relay_outbox task.
+
+    If a session is given, the event is only added to it and thus stored,
+    or not, along with the change it notifies. Otherwise, it is stored right
+    away.
+    """
+    entry = model.PagureTaigaOutbox(
+        topic=topic, message=json.dumps(message), correlation_id=correlation_id
+    )
+    if session is not None:
+        session.add(entry)
+        return
+
+    session = _get_session()
+    try:
+        session.add(entry)
+        session.commit()
+    finally:
+        session.remove()
+
+
+def _pop_ticket_events(ticket_key):
+    """ Return and remove the events queued for the specified ticket. """
+    pipe = get_redis().pipeline()
+    pipe.lrange(EVENTS_KEY % ticket_key, 0, -1)
+    pipe.delete(EVENTS_KEY % ticket_key)
+    pipe.delete(PENDING_KEY % ticket_key)
+    events = pipe.execute()[0]
+    return [json.loads(event) for event in events]
+
+
+def _sync_ticket_events(session, events):
+    """ Sync to taiga the given events, all concerning the same ticket.
+
+    Everything which can be checked locally is checked first, so syncing a
+    ticket costs at most one round-trip to taiga before the actual changes,
+    the statuses of the project being cached.
+    """
+    data = events[-1]["message"]
+    project = _get_project_from_pagure(session, data)
+    api = client.get_api(project.taiga)
+
+    mapping = find_mapping_from_pagure(
+        session,
+        project.taiga,
+        project.taiga.taiga_project_id,
+        data["issue"]["id"],
     )
     if not mapping:
-        print("No corresponding issue found in our mapping")
+        _log.info("No corresponding issue found in our mapping")
+        return
+    issue_type = mapping.taiga_type
+
+    comments = _get_unsynced_comments(
+        session,
+        mapping,
+        [
+            event["message"]["issue"]["comments"][-1]
+            for event in events
+            if event["topic"] == "issue.comment.added"
+        ],
+    )
+    tags_changes = [
+        event["message"]["tags"]
+        for event in events
+        if event["topic"] == "issue.tag.added"
+    ]
+    if not comments and not tags_changes:
         return
 
-    issue = taiga_project.get_userstory_by_ref(mapping.taiga_id)
-    new_status = None
-    for tag in issue_tags:
-        if tag in statuses_text:
-            if new_status and statuses_text.index(tag) > new_status:
-                new_status = statuses_text.index(tag)
+    statuses = None
+    if tags_changes:
+        statuses = client.get_status_index(api, project.taiga, issue_type)
+
+    # The status of the user stories can be changed in bulk, sparing the
+    # lookup of the ticket when there is no comment to post on it. Changing
+    # it in bulk would move the stories out of their swimlane, so the
+    # projects with swimlanes have them changed one by one
+    window = pagure_config.get("PAGURE_TAIGA_BULK_WINDOW", 0)
+    bulk = bool(
+        window
+        and mapping.taiga_type == "userstory"
+        and mapping.taiga_object_id is not None
+        and not client.has_swimlanes(api, project.taiga)
+    )
+
+    issue = None
+    if comments or not bulk:
+        issue = get_mapped_ticket(api, mapping)
+    if issue:
+        store_taiga_object_id(session, mapping, issue.id)
+    elif comments or not bulk:
+        return
+
+    if comments:
+        _post_comments_on_taiga(
+            session, api, issue_type, mapping, issue, comments
+        )
+
+    # The last status change wins
+    for tags in reversed(tags_changes):
+        status = _resolve_status(statuses, tags)
+        if status:
+            if issue is None:
+                queue_status_change(mapping, window, *status)
             else:
-                new_status = statuses_text.index(tag)
-    if new_status:
-        _log.info(
-            "Updating the status to %s (id:%s)",
-            statuses_text[new_status],
-            statuses[new_status].id,
+                if window and mapping.taiga_type == "userstory":
+                    # An older change still queued must not override this one
+                    get_redis().hdel(
+                        STATUSES_KEY % mapping.taiga_project, issue.id
+                    )
+                _update_status_on_taiga(mapping, issue, *status)
+            break
+
+
+def _push_back_ticket_events(ticket_key, events):
+    """ Put back the given events at the head of the queue of the
+    specified ticket.
+    """
+    get_redis().lpush(
+        EVENTS_KEY % ticket_key,
+        *[json.dumps(event) for event in reversed(events)]
+    )
+
+
+def queue_status_change(mapping, window, status_name, status_id):
+    """ Queue the change of the status of the taiga user story of the given
+    mapping so all the changes made on the user stories of the same project
+    within the given number of seconds are sent to taiga by a single
+    sync_statuses task.
+    """
+    taiga_project_id = mapping.taiga_project
+    pipe = get_redis().pipeline()
+    # A later change of the same user story replaces the earlier one
+    pipe.hset(
+        STATUSES_KEY % taiga_project_id,
+        mapping.taiga_object_id,
+        json.dumps(
+            {
+                "ref": mapping.taiga_id,
+                "status_name": status_name,
+                "status_id": status_id,
+            }
+        ),
+    )
+    pipe.set(
+        STATUSES_PENDING_KEY % taiga_project_id,
+        1,
+        nx=True,
+        ex=window * 10 + 60,
+    )
+    _, first = pipe.execute()
+    if first:
+        sync_statuses.apply_async(args=(taiga_project_id,), countdown=window)
+    else:
+        _log.debug(
+            "Sync of statuses of %s already scheduled", taiga_project_id
         )
-        issue.status = statuses[new_status].id
-        issue.update()
+
+
+def _pop_status_changes(taiga_project_id):
+    """ Return and remove the status changes queued for the specified taiga
+    project, as a dict mapping the identifier of each user story to its
+    change.
+    """
+    pipe = get_redis().pipeline()
+    pipe.hgetall(STATUSES_KEY % taiga_project_id)
+    pipe.delete(STATUSES_KEY % taiga_project_id)
+    pipe.delete(STATUSES_PENDING_KEY % taiga_project_id)
+    changes = pipe.execute()[0]
+    return dict(
+        (int(object_id), json.loads(change))
+        for object_id, change in changes.items()
+    )
+
+
+def _push_back_status_changes(taiga_project_id, changes):
+    """ Put back the given status changes in the queue of the specified
+    taiga project, unless the user story changed again since.
+    """
+    pipe = get_redis().pipeline()
+    for object_id, change in changes.items():
+        pipe.hsetnx(
+            STATUSES_KEY % taiga_project_id, object_id, json.dumps(change)
+        )
+    pipe.execute()
+
+
+def taiga_retry(function):
+    """ Decorator retrying the decorated task, after a jittered
+    exponential delay, when taiga asks us to slow down or is unavailable.
+    """
+
+    @functools.wraps(function)
+    def decorated_function(self, *args, **kwargs):
+        try:
+            return function(self, *args, **kwargs)
+        except client.TaigaUnavailable as err:
+            delay = min(
+                pagure_config.get("PAGURE_TAIGA_RETRY_DELAY", 2)
+                * 2 ** self.request.retries,
+                600,
+            )
+            countdown = max(
+                random.uniform(delay / 2.0, delay), err.retry_after or 0
+            )
+            _log.info(
+                "Taiga unavailable (%s), retrying in %.1fs",
+                err.status_code,
+                countdown,
+            )
+            raise self.retry(
+                exc=err,
+                countdown=countdown,
+                max_retries=pagure_config.get("PAGURE_TAIGA_MAX_RETRIES", 8),
+            )
+
+    return decorated_function
 
 
 @conn.task(
     queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
 )
+@ordering.ordered
+@taiga_retry
 @pagure_task
-def delete_ticket_on_pagure_from_taiga(self, session, taiga_data):
-    """ Delete the ticket in pagure based on the information provided by
+def new_ticket(self, session, data):
+    """ Create a new ticket on taiga. """
+    project = _get_project_from_pagure(session, data)
+
+    api = client.get_api(project.taiga)
+    taiga_type = get_taiga_type(project.taiga)
+
+    taiga_project = client.get_project(api, project.taiga)
+    if find_mapping_from_pagure(
+        session, project.taiga, taiga_project.id, data["issue"]["id"]
+    ):
+        _log.info("Ticket already exists in taiga, bailing")
+        return
+
+    _log.info("Adding %s to taiga", taiga_type)
+    taiga_ticket = create_taiga_ticket(
+        taiga_project,
+        taiga_type,
+        title=data["issue"]["title"],
+        content=data["issue"]["content"],
+        priority=data["issue"]["priority"],
+        status=data["issue"]["status"],
+    )
+    _log.info(
+        "Adding mapping: %s to %s for project: %s",
+        taiga_ticket.ref,
+        data["issue"]["id"],
+        taiga_project.id,
+    )
+    mapping = model.PagureTaigaMapping(
+        taiga_project=taiga_project.id,
+        taiga_id=taiga_ticket.ref,
+        pagure_ticket_id=data["issue"]["id"],
+        taiga_type=taiga_type,
+        taiga_object_id=taiga_ticket.id,
+        comments_recorded=True,
+    )
+    session.add(mapping)
+    session.commit()
+    _log.info("Ticket created in taiga from pagure")
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@taiga_retry
+@pagure_task
+def new_comment_ticket(self, session, data):
+    """ Add a new comment on a ticket in taiga. """
+    _sync_ticket_events(
+        session, [{"topic": "issue.comment.added", "message": data}]
+    )
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@taiga_retry
+@pagure_task
+def delete_ticket_on_taiga_from_pagure(self, session, data):
+    """ Delete the ticket in taiga based on the information provided by
+    pagure.
+    """
+    project = _get_project_from_pagure(session, data)
+
+    api = client.get_api(project.taiga)
+
+    taiga_project = client.get_project(api, project.taiga)
+
+    mapping = find_mapping_from_pagure(
+        session, project.taiga, taiga_project.id, data["issue"]["id"]
+    )
+    if not mapping:
+        _log.info("No corresponding issue found in our mapping")
+        return
+
+    try:
+        object_id = mapping.taiga_object_id
+        if object_id is None:
+            object_id = get_mapped_ticket(api, mapping).id
+        idempotency.record(
+            "taiga",
+            mapping.taiga_type,
+            mapping.taiga_project,
+            mapping.taiga_id,
+            "delete",
+        )
+        client.delete_ticket(api, mapping.taiga_type, object_id)
+        session.delete(mapping)
+        session.commit()
+    except client.TaigaUnavailable:
+        raise
+    except taiga.exceptions.TaigaRestException:
+        _log.exception("Could find/delete the ticket")
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@pagure_task
+def create_ticket_from_taiga(self, session, taiga_data):
+    """ Creates a ticket in pagure based on the information provided by
+    taiga's webhook.
+    """
+    project, mapping, _ = resolve_taiga_ticket(session, taiga_data)
+    if not project:
+        _log.info("No pagure project found associated, bailing")
+        return
+
+    # Check if issue already exists
+    _log.info("Checking if the ticket exists in the pagure's project")
+    if mapping:
+        _log.info("Ticket already in the database, bailing")
+        return
+
+    _create_ticket_from_taiga(session, project, taiga_data)
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@pagure_task
+def comment_on_ticket_from_taiga(self, session, taiga_data):
+    """ Comment on a ticket in pagure based on the information provided by
     taiga's webhook.
     """
-    print(dir(session))
+    project, mapping, issue = _get_issue(session, taiga_data)
+    if not issue:
+        _log.info("No corresponding issue found")
+        return
+
+    if _add_comment_from_taiga(
+        session, project, mapping, issue, taiga_data["comment"]
+    ):
+        session.commit()
+    else:
+        _log.info("Comment already existing on the ticket, bailing")
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@pagure_task
+def update_ticket_status_from_taiga(self, session, taiga_data):
+    """ Update the status of a ticket in pagure based on the information
+    provided by taiga's webhook.
+    """
+    project, _, issue = _get_issue(session, taiga_data)
+    if not issue:
+        _log.info("No corresponding issue found")
+        return
+
+    _update_statuses_from_taiga(session, project, [(issue, taiga_data)])
     session.commit()
-    session.expunge_all()
 
-    taiga_project_id = taiga_data["data"]["project"]["id"]
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@pagure_task
+def update_tickets_status_from_taiga(self, session, taiga_data_list):
+    """ Update the status of several tickets of a pagure project, in a
+    single transaction, based on a list of information provided by taiga.
+
+    All the tickets are resolved before any of them is changed, the ones not
+    linked to a pagure ticket are skipped.
+    """
+    project = None
+    changes = []
+    for taiga_data in taiga_data_list:
+        project, mapping, issue = resolve_taiga_ticket(session, taiga_data)
+        if not issue:
+            _log.info(
+                "No corresponding issue found for ref %s", taiga_data["ref"]
+            )
+            continue
+        store_taiga_object_id(session, mapping, taiga_data["id"], commit=False)
+        changes.append((issue, taiga_data))
+    if not changes:
+        return
+
+    _log.info("Updating the status of %s tickets", len(changes))
+    _update_statuses_from_taiga(session, project, changes)
+    session.commit()
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@taiga_retry
+@pagure_task
+def update_ticket_status_on_taiga(self, session, data):
+    """ Update the status of a ticket in taiga based on the information
+    provided by pagure.
+    """
+    _sync_ticket_events(
+        session, [{"topic": "issue.tag.added", "message": data}]
+    )
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@taiga_retry
+@pagure_task
+def sync_ticket(self, session, ticket_key):
+    """ Sync to taiga, in one go, the comments and status changes made on
+    a ticket in pagure and queued by queue_ticket_event.
+    """
+    events = _pop_ticket_events(ticket_key)
+    if not events:
+        _log.info("No event queued for %s, bailing", ticket_key)
+        return
+    _log.info(
+        "Syncing %s events for ticket %s, correlation_ids=%s",
+        len(events),
+        ticket_key,
+        ",".join(event.get("correlation_id") or "-" for event in events),
+    )
+    if len(events) > 1:
+        metrics.COALESCED_EVENTS.inc(len(events) - 1)
+
+    try:
+        _sync_ticket_events(session, events)
+    except client.TaigaUnavailable:
+        # Put the events back in the queue for the task to be retried
+        _push_back_ticket_events(ticket_key, events)
+        raise
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@taiga_retry
+@pagure_task
+def sync_statuses(self, session, taiga_project_id):
+    """ Send to taiga, one request per status, the status changes of user
+    stories queued by queue_status_change, falling back to changing them
+    one by one if taiga does not support it or if swimlanes were added to
+    the project since they were queued.
+    """
+    changes = _pop_status_changes(taiga_project_id)
+    if not changes:
+        _log.info("No status change queued for %s, bailing", taiga_project_id)
+        return
     project = get_pagure_project_from_taiga(session, taiga_project_id)
     if not project:
         _log.info("No pagure project found associated, bailing")
         return
+    api = client.get_api(project.taiga)
+    bulk = not client.has_swimlanes(api, project.taiga)
 
-    issue = _get_issue(session, project, taiga_data)
-    if not issue:
+    groups = {}
+    for object_id, change in changes.items():
+        groups.setdefault(change["status_id"], []).append(object_id)
+    _log.info(
+        "Syncing %s status changes of %s in %s requests",
+        len(changes),
+        taiga_project_id,
+        len(groups),
+    )
+
+    pending = dict(changes)
+    try:
+        for status_id, object_ids in groups.items():
+            for object_id in object_ids:
+                idempotency.record(
+                    "taiga",
+                    "userstory",
+                    taiga_project_id,
+                    changes[object_id]["ref"],
+                    "status",
+                    changes[object_id]["status_name"],
+                )
+            if bulk:
+                try:
+                    client.bulk_update_status(
+                        api, taiga_project_id, status_id, object_ids
+                    )
+                    metrics.BULK_STATUS_CHANGES.inc(
+                        len(object_ids), mode="bulk"
+                    )
+                    for object_id in object_ids:
+                        pending.pop(object_id)
+                    continue
+                except client.TaigaUnavailable:
+                    raise
+                except taiga.exceptions.TaigaRestException:
+                    _log.exception("Bulk status change failed, one by one")
+            for object_id in object_ids:
+                try:
+                    ticket = client.get_ticket(
+                        api, "userstory", object_id=object_id
+                    )
+                    ticket.status = status_id
+                    ticket.update()
+                    metrics.BULK_STATUS_CHANGES.inc(mode="single")
+                except client.TaigaUnavailable:
+                    raise
+                except taiga.exceptions.TaigaRestException:
+                    # Deleted or changed meanwhile, the others are still made
+                    _log.exception(
+                        "Could not change the status of %s", object_id
+                    )
+                pending.pop(object_id)
+    except client.TaigaUnavailable:
+        # Put the changes not made back in the queue for the task to be
+        # retried
+        _push_back_status_changes(taiga_project_id, pending)
+        raise
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@pagure_task
+def delete_ticket_on_pagure_from_taiga(self, session, taiga_data):
+    """ Delete the ticket in pagure based on the information provided by
+    taiga's webhook.
+    """
+    # The ticket is never created when it is not mapped: a deletion started
+    # in pagure removes the mapping before taiga notifies it back
+    project, mapping, issue = resolve_taiga_ticket(session, taiga_data)
+    if not mapping or not issue:
         _log.info("No corresponding issue found")
         return
 
     # username = taiga_data["by"]["username"]
     username = "pingou"
 
+    idempotency.record("pagure", project.id, issue.id, "drop")
     pagure.lib.query.drop_issue(session=session, issue=issue, user=username)
-    mapping = get_ticket_mapping_from_taiga(
-        session,
-        taiga_project_id,
-        taiga_data["data"]["ref"],
-        taiga_data["type"],
+    session.delete(mapping)
+    session.commit()
+
+
+def _parse_taiga_date(value):
+    """ Return the given date sent by taiga as a naive UTC datetime, as
+    stored by pagure.
+    """
+    parsed = maybe_iso8601(value)
+    return datetime.datetime.utcfromtimestamp(
+        calendar.timegm(parsed.utctimetuple())
     )
-    if mapping:
-        session.delete(mapping)
+
+
+def _taiga_record(taiga_type, ticket, action="change", change=None):
+    """ Return the record, as built by ingest.compact_payload for taiga's
+    webhook, corresponding to the given ticket as returned by taiga's API.
+    """
+    data = dict(
+        ticket,
+        project={"id": ticket["project"]},
+        status=ticket.get("status_extra_info"),
+        tags=[tag[0] for tag in ticket.get("tags") or []],
+        assigned_to=ticket.get("assigned_to_extra_info"),
+        milestone=ticket.get("milestone_name"),
+    )
+    return ingest.compact_payload(
+        {"action": action, "type": taiga_type, "data": data, "change": change}
+    )
+
+
+def _pagure_message(project, issue, **kwargs):
+    """ Return a message, as sent by pagure's signal, about the given issue.
+    """
+    message = {
+        "project": project.to_json(public=True),
+        "issue": issue.to_json(public=True, with_comments=False),
+    }
+    message.update(kwargs)
+    return message
+
+
+def _get_ticket_data(api, taiga_type, lookup):
+    """ Return the document of the taiga ticket of the given type looked up
+    with the given arguments, as returned by _ticket_lookup, or None if there
+    is none.
+    """
+    try:
+        return client.get_ticket_data(api, taiga_type, **lookup)
+    except client.TaigaUnavailable:
+        raise
+    except taiga.exceptions.TaigaRestException as err:
+        if err.status_code == 404:
+            return None
+        raise
+
+
+def _reconcile_ticket(
+    session,
+    api,
+    project,
+    taiga_type,
+    statuses,
+    mapping,
+    issue,
+    ticket,
+    status_changes,
+):
+    """ Compare the given pagure issue and taiga ticket, linked by the given
+    mapping, and queue the tasks repairing their differences. The status
+    changes to make in pagure are added to the given list instead, to be
+    made in batches.
+    """
+    if not mapping.comments_recorded:
+        # Otherwise the comments synced before they were recorded would be
+        # seen as missing on both sides
+        record_history_comments(session, api, mapping, issue, ticket["id"])
+
+    if issue.title != ticket["subject"]:
+        # Titles are only synced when the tickets are created
+        _log.info(
+            "Title of %s differs from taiga ref %s", issue, mapping.taiga_id
+        )
+        metrics.DIVERGENCES.inc(kind="title")
+
+    taiga_status = (ticket.get("status_extra_info") or {}).get("name")
+    pagure_status = _resolve_status(statuses, issue.tags_text)
+    pagure_status = pagure_status[0] if pagure_status else None
+    if taiga_status != pagure_status:
+        if pagure_status and issue.last_updated > _parse_taiga_date(
+            ticket["modified_date"]
+        ):
+            metrics.DIVERGENCES.inc(kind="status_to_taiga")
+            queue_ticket_event(
+                "issue.tag.added",
+                _pagure_message(project, issue, tags=issue.tags_text),
+            )
+        else:
+            metrics.DIVERGENCES.inc(kind="status_from_taiga")
+            change = {
+                "diff": {"status": {"from": pagure_status, "to": taiga_status}}
+            }
+            status_changes.append(
+                _taiga_record(taiga_type, ticket, change=change)
+            )
+
+    rows = session.query(
+        model.PagureTaigaComment.pagure_comment_id,
+        model.PagureTaigaComment.comment_hash,
+    ).filter(model.PagureTaigaComment.mapping_id == mapping.id)
+    synced = set()
+    hashes = set()
+    for row in rows:
+        synced.add(row.pagure_comment_id)
+        hashes.add(row.comment_hash)
+    recorded = False
+    for comment in issue.comments:
+        # The notifications of pagure (metadata updates...) are never synced
+        if comment.id in synced or comment.notification:
+            continue
+        comment_hash = hash_comment(comment.comment)
+        if comment_hash in hashes:
+            # Repeats a comment already synced, which sync_ticket skips: it
+            # would otherwise be found missing by every reconciliation
+            session.add(
+                model.PagureTaigaComment(
+                    mapping_id=mapping.id,
+                    pagure_comment_id=comment.id,
+                    comment_hash=comment_hash,
+                )
+            )
+            synced.add(comment.id)
+            recorded = True
+            continue
+        metrics.DIVERGENCES.inc(kind="comment_to_taiga")
+        message = _pagure_message(project, issue)
+        message["issue"]["comments"] = [comment.to_json(public=True)]
+        queue_ticket_event("issue.comment.added", message)
+    if recorded:
+        session.commit()
+    if ticket.get("total_comments", 0) > len(synced):
+        metrics.DIVERGENCES.inc(kind="comment_from_taiga")
+        record = _taiga_record(taiga_type, ticket)
+        ordering.apply_in_order(
+            pull_comments_from_taiga, ordering.taiga_key(record), (record,)
+        )
+
+
+def _reconcile_changes(session, project, since):
+    """ Compare the tickets of the given pagure project and of its taiga
+    project changed, on either side, since the given date and queue the
+    tasks repairing their differences.
+    """
+    taiga_config = project.taiga
+    api = client.get_api(taiga_config)
+    taiga_type = get_taiga_type(taiga_config)
+    taiga_project_id = taiga_config.taiga_project_id
+    statuses = client.get_status_index(api, taiga_config, taiga_type)
+
+    issues = dict(
+        (issue.id, issue)
+        for issue in session.query(pagure.lib.model.Issue).filter(
+            pagure.lib.model.Issue.project_id == project.id,
+            pagure.lib.model.Issue.last_updated >= since,
+        )
+    )
+    tickets = dict(
+        (ticket["ref"], ticket)
+        for ticket in client.iter_tickets(
+            api,
+            taiga_project_id,
+            taiga_type,
+            modified_date__gte=since.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        )
+    )
+    _log.info(
+        "Reconciling %s: %s tickets changed in pagure, %s in taiga",
+        project.fullname,
+        len(issues),
+        len(tickets),
+    )
+
+    conditions = []
+    if issues:
+        conditions.append(
+            model.PagureTaigaMapping.pagure_ticket_id.in_(list(issues))
+        )
+    if tickets:
+        conditions.append(model.PagureTaigaMapping.taiga_id.in_(list(tickets)))
+    if not conditions:
+        return
+    mappings = session.query(model.PagureTaigaMapping).filter(
+        model.PagureTaigaMapping.taiga_project == taiga_project_id,
+        model.PagureTaigaMapping.taiga_type == taiga_type,
+        sa.or_(*conditions),
+    )
+
+    # Loaded at once, the comments of a mapping may be recorded (and
+    # committed) while reconciling it
+    mappings = mappings.all()
+
+    # The tickets only changed in pagure are looked up in taiga all at once
+    missing = [
+        mapping for mapping in mappings if mapping.taiga_id not in tickets
+    ]
+    fetched = client.map_concurrently(
+        lambda lookup: _get_ticket_data(api, *lookup),
+        [(mapping.taiga_type, _ticket_lookup(mapping)) for mapping in missing],
+    )
+    for mapping, ticket in zip(missing, fetched):
+        if ticket is not None:
+            tickets[mapping.taiga_id] = ticket
+
+    status_changes = []
+    for mapping in mappings:
+        issue = issues.pop(mapping.pagure_ticket_id, None)
+        if issue is None:
+            issue = pagure.lib.query.search_issues(
+                session, project, issueid=mapping.pagure_ticket_id
+            )
+        ticket = tickets.pop(mapping.taiga_id, None)
+        if issue is None or ticket is None:
+            continue
+        _reconcile_ticket(
+            session,
+            api,
+            project,
+            taiga_type,
+            statuses,
+            mapping,
+            issue,
+            ticket,
+            status_changes,
+        )
+
+    # The status changes to make in pagure are made by batches, each in a
+    # single transaction, once the tasks in flight for their tickets are done
+    batch_size = pagure_config.get("PAGURE_TAIGA_RECONCILE_BATCH_SIZE", 100)
+    for start in range(0, len(status_changes), batch_size):
+        batch = status_changes[start : start + batch_size]
+        ordering.apply_in_order(
+            update_tickets_status_from_taiga,
+            [ordering.taiga_key(record) for record in batch],
+            (batch,),
+        )
+
+    # Tickets created since the last reconciliation but never synced. Their
+    # own creation may still be queued: the repairs run after it, in order,
+    # and find the ticket created
+    for issue in issues.values():
+        if issue.date_created >= since:
+            metrics.DIVERGENCES.inc(kind="ticket_to_taiga")
+            message = _pagure_message(project, issue)
+            ordering.apply_in_order(
+                new_ticket, ordering.pagure_key(message), (message,)
+            )
+    for ticket in tickets.values():
+        if _parse_taiga_date(ticket["created_date"]) >= since:
+            metrics.DIVERGENCES.inc(kind="ticket_from_taiga")
+            record = _taiga_record(taiga_type, ticket, action="create")
+            ordering.apply_in_order(
+                create_ticket_from_taiga,
+                ordering.taiga_key(record),
+                (record,),
+            )
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@pagure_task
+def reconcile(self, session):
+    """ Queue the reconciliation of each project linked to taiga, spreading
+    them over the workers.
+    """
+    for row in session.query(model.PagureTaiga.project_id):
+        reconcile_project.delay(row.project_id)
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@taiga_retry
+@pagure_task
+def reconcile_project(self, session, project_id):
+    """ Compare the tickets of the specified pagure project and of its
+    taiga project changed, on either side, since the last reconciliation and
+    queue the tasks repairing their differences.
+    """
+    project = session.query(pagure.lib.model.Project).get(project_id)
+    if not project or not project.taiga:
+        _log.info("Project %s not linked to taiga, bailing", project_id)
+        return
+
+    lock = RECONCILE_LOCK_KEY % project_id
+    interval = pagure_config.get("PAGURE_TAIGA_RECONCILE_INTERVAL", 900)
+    if not get_redis().set(lock, 1, nx=True, ex=interval or 900):
+        _log.info("%s already being reconciled, bailing", project.fullname)
+        return
+
+    try:
+        started = datetime.datetime.utcnow()
+        since = project.taiga.reconciled_at
+        if since is None:
+            # The tickets existing before are linked by backfill.py
+            _log.info("First reconciliation of %s", project.fullname)
+        else:
+            _reconcile_changes(session, project, since)
+        project.taiga.reconciled_at = started
+        session.add(project.taiga)
+        session.commit()
+    finally:
+        get_redis().delete(lock)
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@ordering.ordered
+@taiga_retry
+@pagure_task
+def pull_comments_from_taiga(self, session, taiga_data):
+    """ Add on a ticket in pagure the comments of its taiga ticket missing
+    from it.
+    """
+    project, mapping, issue = resolve_taiga_ticket(session, taiga_data)
+    if not mapping or not issue:
+        _log.info("No corresponding issue found")
+        return
+
+    api = client.get_api(project.taiga)
+    for text in get_taiga_comments(api, taiga_data["type"], taiga_data["id"]):
+        _add_comment_from_taiga(session, project, mapping, issue, text)
     session.commit()
+
+
+def _queue_task(task):
+    """ Return the function queuing the given task for an event received
+    from pagure.
+    """
+
+    def queue(topic, message, correlation_id):
+        ordering.apply_in_order(
+            task,
+            ordering.pagure_key(message),
+            (message,),
+            task_id=correlation_id,
+        )
+
+    return queue
+
+
+# Function queuing the sync of each topic of pagure's signal synced to taiga,
+# any other topic is ignored
+DISPATCH = {
+    "issue.new": _queue_task(new_ticket),
+    "issue.drop": _queue_task(delete_ticket_on_taiga_from_pagure),
+}
+DISPATCH.update((topic, queue_ticket_event) for topic in COALESCED_TOPICS)
+
+
+@conn.task(
+    queue=pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE", None), bind=True
+)
+@pagure_task
+def relay_outbox(self, session):
+    """ Relay to celery, in batches and in order, the events stored in the
+    outbox.
+
+    Each event is removed once queued. An event which cannot be relayed is
+    tried again by the next runs, up to PAGURE_TAIGA_OUTBOX_MAX_ATTEMPTS
+    times, after which it is set aside (left in the outbox, ignored) so it
+    does not block the others.
+    """
+    lock_ttl = pagure_config.get("PAGURE_TAIGA_OUTBOX_LOCK_TTL", 300)
+    if not get_redis().set(OUTBOX_LOCK_KEY, 1, nx=True, ex=lock_ttl):
+        _log.debug("Outbox already being relayed, bailing")
+        return
+
+    try:
+        batch_size = pagure_config.get("PAGURE_TAIGA_OUTBOX_BATCH_SIZE", 100)
+        max_attempts = pagure_config.get("PAGURE_TAIGA_OUTBOX_MAX_ATTEMPTS", 5)
+        while True:
+            entries = (
+                session.query(model.PagureTaigaOutbox)
+                .filter(
+                    sa.or_(
+                        model.PagureTaigaOutbox.attempts.is_(None),
+                        model.PagureTaigaOutbox.attempts < max_attempts,
+                    )
+                )
+                .order_by(model.PagureTaigaOutbox.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not entries:
+                break
+            now = datetime.datetime.utcnow()
+            relayed = []
+            try:
+                for entry in entries:
+                    try:
+                        DISPATCH[entry.topic](
+                            entry.topic,
+                            json.loads(entry.message),
+                            entry.correlation_id,
+                        )
+                    except (OperationalError, redis.RedisError):
+                        # The broker or redis is unavailable, not the event
+                        # at fault: it is relayed again by the next run
+                        raise
+                    except Exception:
+                        entry.attempts = (entry.attempts or 0) + 1
+                        _log.exception(
+                            "Could not relay the event %s (attempt %s/%s)",
+                            entry.id,
+                            entry.attempts,
+                            max_attempts,
+                        )
+                        continue
+                    relayed.append(entry.id)
+                    metrics.OUTBOX_LAG.observe(
+                        (now - entry.date_created).total_seconds()
+                    )
+            finally:
+                # The events queued are removed even if the batch could not
+                # be relayed entirely, so they are not queued twice
+                if relayed:
+                    session.query(model.PagureTaigaOutbox).filter(
+                        model.PagureTaigaOutbox.id.in_(relayed)
+                    ).delete(synchronize_session=False)
+                session.commit()
+                metrics.OUTBOX_RELAYED.inc(len(relayed))
+            _log.info("Relayed %s events from the outbox", len(relayed))
+            if len(relayed) < len(entries):
+                # Failed events are only tried again by the next run
+                break
+    finally:
+        get_redis().delete(OUTBOX_LOCK_KEY)
+
+
+# Periodic tasks, scheduled by the worker started with --beat
+_SCHEDULE = {}
+_SCHEDULE_OPTIONS = {"queue": pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE")}
+if pagure_config.get("PAGURE_TAIGA_RECONCILE_INTERVAL", 900):
+    _SCHEDULE["pagure-taiga-reconcile"] = {
+        "task": reconcile.name,
+        "schedule": pagure_config.get("PAGURE_TAIGA_RECONCILE_INTERVAL", 900),
+        "options": _SCHEDULE_OPTIONS,
+    }
+if pagure_config.get("PAGURE_TAIGA_OUTBOX", False):
+    _SCHEDULE["pagure-taiga-relay-outbox"] = {
+        "task": relay_outbox.name,
+        "schedule": pagure_config.get("PAGURE_TAIGA_OUTBOX_INTERVAL", 1),
+        "options": _SCHEDULE_OPTIONS,
+    }
+conn.conf.beat_schedule = dict(conn.conf.beat_schedule or {}, **_SCHEDULE)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import logging
+import time
+
+import redis
+
+from pagure.config import config as pagure_config
+
+from pagure_taiga.utils import get_redis
+
+_log = logging.getLogger(__name__)
+
+
+# Token bucket shared, via redis, by all the processes talking to a taiga
+# instance. If the bucket is empty, a token is borrowed and the caller is
+# told how long to wait before using it, unless that is longer than the
+# given maximum: the request is then refused and no token is taken, so the
+# refused requests do not slow down the others.
+# Returns the number of seconds to wait, as a string to keep the decimals,
+# and whether the request is refused.
+_ACQUIRE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "stamp")
+local tokens = tonumber(bucket[1]) or burst
+local stamp = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate) - 1
+local wait = 0
+if tokens < 0 then
+    wait = -tokens / rate
+end
+local blocked = tonumber(redis.call("GET", KEYS[2]) or 0)
+if blocked > now + wait then
+    wait = blocked - now
+end
+if wait > max_wait then
+    return {tostring(wait), 1}
+end
+redis.call("HMSET", KEYS[1], "tokens", tokens, "stamp", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 60)
+return {tostring(wait), 0}
+"""
+
+BUCKET_KEY = "pagure_taiga:ratelimit:%s:bucket"
+BLOCKED_KEY = "pagure_taiga:ratelimit:%s:blocked"
+PENALTY_KEY = "pagure_taiga:ratelimit:%s:penalty"
+
+_SCRIPT = None
+
+
+def acquire(host):
+    """ Wait until a request can be sent to the specified taiga instance
+    without exceeding PAGURE_TAIGA_RATE_LIMIT requests per second across all
+    pagure-taiga processes, or while the instance asked us to back off.
+
+    Waits longer than PAGURE_TAIGA_RATE_MAX_WAIT seconds are not made, so
+    they do not hold a worker (or a web request), the number of seconds to
+    wait is returned instead and the request should not be sent. No token is
+    taken for such a request.
+    """
+    global _SCRIPT
+    rate = pagure_config.get("PAGURE_TAIGA_RATE_LIMIT", 10)
+    if not rate:
+        return
+    burst = pagure_config.get("PAGURE_TAIGA_RATE_BURST", 20)
+    max_wait = pagure_config.get("PAGURE_TAIGA_RATE_MAX_WAIT", 1)
+    try:
+        if _SCRIPT is None:
+            _SCRIPT = get_redis().register_script(_ACQUIRE_SCRIPT)
+        wait, refused = _SCRIPT(
+            keys=[BUCKET_KEY % host, BLOCKED_KEY % host],
+            args=[rate, burst, time.time(), max_wait],
+        )
+        wait = float(wait)
+    except redis.RedisError:
+        _log.exception("Could not rate-limit the requests to %s", host)
+        return
+    if refused:
+        _log.info("Not waiting %.2fs before querying %s", wait, host)
+        return wait
+    if wait > 0:
+        _log.debug("Waiting %.2fs before querying %s", wait, host)
+        time.sleep(wait)
+
+
+def back_off(host, retry_after=None):
+    """ Block all the requests to the specified taiga instance for the
+    number of seconds it asked for via its Retry-After header, up to
+    PAGURE_TAIGA_MAX_RETRY_AFTER, or, if it did not, for a delay doubling
+    each time it rejects us within a minute.
+
+    Returns the number of seconds the requests are blocked for.
+    """
+    conn = get_redis()
+    try:
+        penalty = conn.incr(PENALTY_KEY % host)
+        conn.expire(PENALTY_KEY % host, 60)
+    except redis.RedisError:
+        _log.exception("Could not back off the requests to %s", host)
+        penalty = 1
+    max_retry_after = pagure_config.get("PAGURE_TAIGA_MAX_RETRY_AFTER", 300)
+    if retry_after is None:
+        retry_after = 2 ** penalty
+    retry_after = min(retry_after, max_retry_after)
+    try:
+        conn.set(
+            BLOCKED_KEY % host,
+            time.time() + retry_after,
+            ex=int(retry_after) + 1,
+        )
+    except redis.RedisError:
+        _log.exception("Could not back off the requests to %s", host)
+    _log.info("Backing off from %s for %ss", host, retry_after)
+    return retry_after
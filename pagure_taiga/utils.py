@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import hashlib
+import logging
+import os
+import uuid
+
+import redis
+from celery import current_task
+
+from pagure.config import config as pagure_config
+
+
+_REDIS = None
+
+
+def get_broker_url():
+    """ Return the URL of the celery broker pagure-taiga uses. """
+    if os.environ.get("PAGURE_BROKER_URL"):
+        return os.environ["PAGURE_BROKER_URL"]
+    elif pagure_config.get("BROKER_URL"):
+        return pagure_config["BROKER_URL"]
+    return "redis://%s" % pagure_config["REDIS_HOST"]
+
+
+def get_redis():
+    """ Return the connection (pool) to the redis server used by
+    pagure-taiga to coordinate its web and worker processes, the one used
+    as celery broker unless PAGURE_TAIGA_REDIS_URL is set.
+    """
+    global _REDIS
+    if _REDIS is None:
+        _REDIS = redis.StrictRedis.from_url(
+            pagure_config.get("PAGURE_TAIGA_REDIS_URL") or get_broker_url()
+        )
+    return _REDIS
+
+
+def new_correlation_id():
+    """ Return a new identifier for an event received, used as the id of
+    the task processing it so the logs of both can be correlated.
+    """
+    return uuid.uuid4().hex
+
+
+class CorrelationIdFilter(logging.Filter):
+    """ Logging filter setting the ``correlation_id`` attribute of the
+    records to the id of the celery task being run, ``-`` outside of tasks.
+    """
+
+    def filter(self, record):
+        task = current_task
+        record.correlation_id = (task and task.request.id) or "-"
+        return True
+
+
+def hash_comment(comment_text):
+    """ Return the hash used to identify the given comment. """
+    return hashlib.sha256(comment_text.strip().encode("utf-8")).hexdigest()
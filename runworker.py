@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 
-from __future__ import unicode_literals, absolute_import
+from __future__ import unicode_literals, absolute_import, print_function
 
 import argparse
-import sys
 import os
-import subprocess
+
+
+POOLS = ("prefork", "threads", "gevent", "eventlet", "solo")
 
 
 parser = argparse.ArgumentParser(description="Run the pagure-taiga worker")
@@ -29,34 +30,157 @@ parser.add_argument(
     default=False,
     help="Reduce the log level.",
 )
+parser.add_argument(
+    "--pool",
+    "-P",
+    dest="pool",
+    choices=POOLS,
+    help="Pool implementation running the tasks, threads/gevent/eventlet "
+    "allow keeping many requests to taiga in flight per process "
+    "(defaults to PAGURE_TAIGA_WORKER_POOL or prefork).",
+)
+parser.add_argument(
+    "--concurrency",
+    dest="concurrency",
+    type=int,
+    help="Number of tasks run concurrently "
+    "(defaults to PAGURE_TAIGA_WORKER_CONCURRENCY or the number of CPUs).",
+)
+parser.add_argument(
+    "--prefetch-multiplier",
+    dest="prefetch_multiplier",
+    type=int,
+    help="Number of tasks reserved at once per unit of concurrency "
+    "(defaults to PAGURE_TAIGA_WORKER_PREFETCH_MULTIPLIER or 4).",
+)
+parser.add_argument(
+    "--max-tasks-per-child",
+    dest="max_tasks_per_child",
+    type=int,
+    help="Number of tasks a prefork child runs before being replaced "
+    "(defaults to PAGURE_TAIGA_WORKER_MAX_TASKS_PER_CHILD or no limit).",
+)
+parser.add_argument(
+    "--beat",
+    "-B",
+    dest="beat",
+    action="store_true",
+    default=None,
+    help="Also run the scheduler of the periodic tasks, such as the "
+    "reconciliation, in this worker. Only one worker should run it "
+    "(defaults to PAGURE_TAIGA_WORKER_BEAT or False).",
+)
+parser.add_argument(
+    "--metrics-port",
+    dest="metrics_port",
+    type=int,
+    help="Port on which to serve the metrics of pagure-taiga, in prometheus' "
+    "format (defaults to PAGURE_TAIGA_WORKER_METRICS_PORT or not served).",
+)
 
 args = parser.parse_args()
 
-env = os.environ
 if args.config:
     config = args.config
     if not config.startswith("/"):
         here = os.path.join(os.path.dirname(os.path.abspath(__file__)))
         config = os.path.join(here, config)
-    env["PAGURE_CONFIG"] = config
-
-cmd = [
-    sys.executable,
-    "-m",
-    "celery",
-    "worker",
-    "-A",
-    "pagure_taiga.query",
-    "-Q",
-    "pagure_taiga",
-]
+    os.environ["PAGURE_CONFIG"] = config
+
+
+def _get_pool():
+    """ Return the pool running the tasks, from the command line, the
+    environment or pagure's configuration file.
+
+    The configuration file is read on its own, as pagure does, rather than
+    via pagure.config: importing pagure (flask, werkzeug...) would import
+    the modules the green pools need to patch first.
+    """
+    if args.pool:
+        return args.pool
+    if os.environ.get("PAGURE_TAIGA_WORKER_POOL"):
+        return os.environ["PAGURE_TAIGA_WORKER_POOL"]
+    config_file = os.environ.get("PAGURE_CONFIG", "/etc/pagure/pagure.cfg")
+    values = {"__file__": config_file}
+    if os.path.exists(config_file):
+        with open(config_file) as stream:
+            exec(compile(stream.read(), config_file, "exec"), values)
+    return values.get("PAGURE_TAIGA_WORKER_POOL", "prefork")
+
+
+pool = _get_pool()
+if pool not in POOLS:
+    parser.error("invalid pool %r, choose from %s" % (pool, ", ".join(POOLS)))
+
+# The green pools need the standard library patched before anything else
+# (sockets, threads...) gets imported, pagure included
+if pool == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
+elif pool == "eventlet":
+    import eventlet
+
+    eventlet.monkey_patch()
+
+from pagure.config import config as pagure_config  # noqa: E402
+
+from pagure_taiga import metrics  # noqa: E402
+from pagure_taiga.query import conn  # noqa: E402
+
+
+def _get_setting(value, key, default=None):
+    """ Return the given value from the command line if it was set or the
+    value of the given key in pagure's configuration otherwise.
+    """
+    if value is not None:
+        return value
+    return pagure_config.get(key, default)
+
+
+queue = pagure_config.get("PAGURE_TAIGA_CELERY_QUEUE") or "pagure_taiga"
+settings = {
+    "worker_pool": pool,
+    "worker_concurrency": _get_setting(
+        args.concurrency, "PAGURE_TAIGA_WORKER_CONCURRENCY"
+    ),
+    "worker_prefetch_multiplier": _get_setting(
+        args.prefetch_multiplier, "PAGURE_TAIGA_WORKER_PREFETCH_MULTIPLIER", 4
+    ),
+    "worker_max_tasks_per_child": _get_setting(
+        args.max_tasks_per_child, "PAGURE_TAIGA_WORKER_MAX_TASKS_PER_CHILD"
+    ),
+}
+conn.conf.update(
+    dict((key, value) for key, value in settings.items() if value is not None)
+)
+
+print("Starting the pagure-taiga worker")
+print("  queue:               %s" % queue)
+print("  pool:                %s" % conn.conf.worker_pool)
+print("  concurrency:         %s" % (conn.conf.worker_concurrency or "#CPUs"))
+print("  prefetch multiplier: %s" % conn.conf.worker_prefetch_multiplier)
+print(
+    "  max tasks per child: %s"
+    % (conn.conf.worker_max_tasks_per_child or "unlimited")
+)
+
+metrics_port = _get_setting(
+    args.metrics_port, "PAGURE_TAIGA_WORKER_METRICS_PORT"
+)
+if metrics_port:
+    metrics.start_http_server(metrics_port)
+    print("  metrics:             http://0.0.0.0:%s/" % metrics_port)
 
+argv = ["worker", "-Q", queue]
+if _get_setting(args.beat, "PAGURE_TAIGA_WORKER_BEAT", False):
+    print("  periodic tasks:      scheduled by this worker")
+    argv.append("--beat")
 if args.debug:
-    cmd.append("--loglevel=debug")
+    argv.append("--loglevel=debug")
 elif args.noinfo:
     pass
 else:
-    cmd.append("--loglevel=info")
+    argv.append("--loglevel=info")
 
-subp = subprocess.Popen(cmd, env=env or None)
-subp.wait()
+conn.worker_main(argv)
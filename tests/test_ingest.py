@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import copy
+import hashlib
+import hmac
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+
+from pagure_taiga import ingest  # noqa: E402
+
+
+PAYLOAD = {
+    "action": "change",
+    "type": "userstory",
+    "by": {"id": 6, "username": "pingou"},
+    "date": "2019-05-13T12:00:00.000Z",
+    "data": {
+        "id": 1234,
+        "ref": 42,
+        "project": {"id": 7, "name": "test", "permalink": "http://..."},
+        "subject": "Test ticket",
+        "description": "A description",
+        "status": {"id": 3, "name": "In progress", "color": "#ff8a84"},
+        "tags": ["easyfix"],
+        "assigned_to": {"id": 6, "username": "pingou"},
+        "milestone": {"id": 2, "name": "Sprint 1"},
+        "watchers": [1, 2, 3],
+    },
+    "change": {
+        "comment": "",
+        "comment_html": "",
+        "delete_comment_date": None,
+        "edit_comment_date": None,
+        "diff": {"status": {"from": "New", "to": "In progress"}},
+    },
+}
+
+
+class CompactPayloadTests(unittest.TestCase):
+    """ Tests for ingest.compact_payload """
+
+    def setUp(self):
+        self.payload = copy.deepcopy(PAYLOAD)
+
+    def test_status_change(self):
+        """ Test compacting the payload of a status change. """
+        record = ingest.compact_payload(self.payload)
+        self.assertEqual(
+            record,
+            {
+                "action": "change",
+                "type": "userstory",
+                "project_id": 7,
+                "id": 1234,
+                "ref": 42,
+                "subject": "Test ticket",
+                "description": "A description",
+                "status": "In progress",
+                "status_color": "#ff8a84",
+                "tags": ["easyfix"],
+                "assigned_to": "pingou",
+                "milestone": "Sprint 1",
+                "comment": None,
+                "comment_edited": False,
+                "comment_deleted": False,
+                "status_from": "New",
+                "status_to": "In progress",
+            },
+        )
+
+    def test_comment(self):
+        """ Test compacting the payload of a new comment. """
+        self.payload["change"] = {
+            "comment": "Looks good",
+            "delete_comment_date": None,
+            "edit_comment_date": None,
+            "diff": {},
+        }
+        record = ingest.compact_payload(self.payload)
+        self.assertEqual(record["comment"], "Looks good")
+        self.assertFalse(record["comment_edited"])
+        self.assertFalse(record["comment_deleted"])
+        self.assertIsNone(record["status_from"])
+        self.assertIsNone(record["status_to"])
+
+    def test_comment_edited_and_deleted(self):
+        """ Test that the edition and deletion of comments are flagged. """
+        self.payload["change"]["comment"] = "Edited"
+        self.payload["change"]["edit_comment_date"] = "2019-05-13T12:01:00Z"
+        record = ingest.compact_payload(self.payload)
+        self.assertTrue(record["comment_edited"])
+        self.assertFalse(record["comment_deleted"])
+
+        self.payload["change"]["delete_comment_date"] = "2019-05-13T12:02:00Z"
+        record = ingest.compact_payload(self.payload)
+        self.assertTrue(record["comment_deleted"])
+
+    def test_creation(self):
+        """ Test compacting the payload of a creation, which has no change
+        and whose optional fields may be null.
+        """
+        del self.payload["change"]
+        self.payload["action"] = "create"
+        self.payload["data"].update(
+            {
+                "description": None,
+                "tags": None,
+                "assigned_to": None,
+                "milestone": None,
+            }
+        )
+        record = ingest.compact_payload(self.payload)
+        self.assertEqual(record["action"], "create")
+        self.assertEqual(record["description"], "")
+        self.assertEqual(record["tags"], [])
+        self.assertIsNone(record["assigned_to"])
+        self.assertIsNone(record["milestone"])
+        self.assertIsNone(record["comment"])
+        self.assertIsNone(record["status_to"])
+
+    def test_identifiers_as_strings(self):
+        """ Test that the identifiers are converted to integers. """
+        self.payload["data"]["id"] = "1234"
+        self.payload["data"]["ref"] = "42"
+        self.payload["data"]["project"]["id"] = "7"
+        record = ingest.compact_payload(self.payload)
+        self.assertEqual(record["id"], 1234)
+        self.assertEqual(record["ref"], 42)
+        self.assertEqual(record["project_id"], 7)
+
+    def test_users_and_milestones_as_values(self):
+        """ Test that users and milestones sent as plain values are kept. """
+        self.payload["data"]["assigned_to"] = 6
+        self.payload["data"]["milestone"] = "Sprint 2"
+        record = ingest.compact_payload(self.payload)
+        self.assertEqual(record["assigned_to"], 6)
+        self.assertEqual(record["milestone"], "Sprint 2")
+
+    def test_unsupported_type(self):
+        """ Test that only the action and type of the objects not synced
+        are kept, whatever their data.
+        """
+        record = ingest.compact_payload(
+            {"action": "change", "type": "task", "data": None}
+        )
+        self.assertEqual(record, {"action": "change", "type": "task"})
+
+    def test_reject_not_an_object(self):
+        """ Test rejecting a payload which is not a JSON object. """
+        for payload in (None, [], "payload", 42):
+            self.assertRaises(
+                ingest.InvalidPayload, ingest.compact_payload, payload
+            )
+
+    def test_reject_missing_field(self):
+        """ Test rejecting payloads missing a required field. """
+        for path in (
+            ("action",),
+            ("type",),
+            ("data",),
+            ("data", "id"),
+            ("data", "ref"),
+            ("data", "project"),
+            ("data", "project", "id"),
+        ):
+            payload = copy.deepcopy(PAYLOAD)
+            parent = payload
+            for key in path[:-1]:
+                parent = parent[key]
+            del parent[path[-1]]
+            self.assertRaises(
+                ingest.InvalidPayload, ingest.compact_payload, payload
+            )
+
+    def test_reject_invalid_field(self):
+        """ Test rejecting payloads having a field of the wrong type. """
+        self.payload["data"]["ref"] = "not a number"
+        self.assertRaises(
+            ingest.InvalidPayload, ingest.compact_payload, self.payload
+        )
+
+        payload = copy.deepcopy(PAYLOAD)
+        payload["data"]["project"] = 7
+        self.assertRaises(
+            ingest.InvalidPayload, ingest.compact_payload, payload
+        )
+
+        payload = copy.deepcopy(PAYLOAD)
+        payload["data"] = "data"
+        self.assertRaises(
+            ingest.InvalidPayload, ingest.compact_payload, payload
+        )
+
+        payload = copy.deepcopy(PAYLOAD)
+        payload["change"] = "change"
+        self.assertRaises(
+            ingest.InvalidPayload, ingest.compact_payload, payload
+        )
+
+
+class VerifySignatureTests(unittest.TestCase):
+    """ Tests for ingest.verify_signature """
+
+    key = "secret key"
+    body = b'{"action": "change", "type": "userstory"}'
+
+    def sign(self, key, body):
+        return hmac.new(key.encode("utf-8"), body, hashlib.sha1).hexdigest()
+
+    def test_valid(self):
+        """ Test accepting the HMAC-SHA1 of the body with the key. """
+        signature = self.sign(self.key, self.body)
+        self.assertTrue(
+            ingest.verify_signature(self.key, self.body, signature)
+        )
+
+    def test_other_key(self):
+        """ Test rejecting a body signed with another key. """
+        signature = self.sign("other key", self.body)
+        self.assertFalse(
+            ingest.verify_signature(self.key, self.body, signature)
+        )
+
+    def test_tampered_body(self):
+        """ Test rejecting a body changed after being signed. """
+        signature = self.sign(self.key, self.body)
+        self.assertFalse(
+            ingest.verify_signature(
+                self.key, self.body.replace(b"change", b"delete"), signature
+            )
+        )
+
+    def test_missing(self):
+        """ Test rejecting a delivery without signature or checked without
+        key, as for a project not linked to taiga.
+        """
+        signature = self.sign(self.key, self.body)
+        self.assertFalse(ingest.verify_signature(self.key, self.body, None))
+        self.assertFalse(ingest.verify_signature(self.key, self.body, ""))
+        self.assertFalse(ingest.verify_signature("", self.body, signature))
+        self.assertFalse(ingest.verify_signature(None, self.body, signature))
+
+    def test_malformed(self):
+        """ Test rejecting signatures which are not a lowercase hex digest,
+        as taiga sends them.
+        """
+        signature = self.sign(self.key, self.body)
+        for value in (
+            signature.upper(),
+            signature[:-1],
+            signature + "0",
+            "\u00e9" * 40,
+        ):
+            self.assertFalse(
+                ingest.verify_signature(self.key, self.body, value)
+            )
+
+    def test_non_ascii_key(self):
+        """ Test signing with a key which is not ASCII. """
+        key = "cl\u00e9 secr\u00e8te"
+        signature = self.sign(key, self.body)
+        self.assertTrue(ingest.verify_signature(key, self.body, signature))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
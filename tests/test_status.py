@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2019 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+"""
+
+from __future__ import unicode_literals, print_function
+
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+
+from pagure_taiga import client  # noqa: E402
+from pagure_taiga import query  # noqa: E402
+
+
+# The statuses of a taiga project, as listed in its document
+STATUSES = [
+    {"id": 11, "name": "New", "order": 1, "color": "#999999"},
+    {"id": 12, "name": "Ready", "order": 2, "color": "#ff8a84"},
+    {"id": 13, "name": "In progress", "order": 3, "color": "#ff9900"},
+    {"id": 14, "name": "Done", "order": 4, "color": "#a8e440"},
+]
+
+
+class StatusIndexTests(unittest.TestCase):
+    """ Tests for client._build_status_index """
+
+    def test_index(self):
+        """ Test indexing the statuses by name. """
+        self.assertEqual(
+            client._build_status_index(STATUSES),
+            {
+                "New": (1, 11),
+                "Ready": (2, 12),
+                "In progress": (3, 13),
+                "Done": (4, 14),
+            },
+        )
+
+    def test_no_status(self):
+        """ Test indexing a project without statuses. """
+        self.assertEqual(client._build_status_index(None), {})
+        self.assertEqual(client._build_status_index([]), {})
+
+
+class ResolveStatusTests(unittest.TestCase):
+    """ Tests for query._resolve_status """
+
+    def setUp(self):
+        self.statuses = client._build_status_index(STATUSES)
+
+    def test_no_match(self):
+        """ Test tags matching no status. """
+        self.assertIsNone(query._resolve_status(self.statuses, []))
+        self.assertIsNone(
+            query._resolve_status(self.statuses, ["easyfix", "bug"])
+        )
+        self.assertIsNone(query._resolve_status({}, ["Done"]))
+
+    def test_single_match(self):
+        """ Test a single tag matching a status among other tags. """
+        self.assertEqual(
+            query._resolve_status(self.statuses, ["easyfix", "Ready"]),
+            ("Ready", 12),
+        )
+
+    def test_first_status(self):
+        """ Test resolving the first status of the workflow. """
+        self.assertEqual(
+            query._resolve_status(self.statuses, ["New"]), ("New", 11)
+        )
+
+    def test_furthest_in_workflow(self):
+        """ Test that, when several tags match a status, the one furthest in
+        the workflow wins, whatever the order of the tags.
+        """
+        self.assertEqual(
+            query._resolve_status(self.statuses, ["Done", "New", "Ready"]),
+            ("Done", 14),
+        )
+        self.assertEqual(
+            query._resolve_status(self.statuses, ["Ready", "Done", "New"]),
+            ("Done", 14),
+        )
+        self.assertEqual(
+            query._resolve_status(self.statuses, ["In progress", "New"]),
+            ("In progress", 13),
+        )
+
+    def test_case_sensitive(self):
+        """ Test that tags only match statuses with the same case. """
+        self.assertIsNone(query._resolve_status(self.statuses, ["done"]))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)